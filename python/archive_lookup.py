@@ -0,0 +1,99 @@
+import argparse
+from collections.abc import Mapping
+from pathlib import Path
+import sys
+import dotenv
+
+from python.src.packstore import PACK_NAME, PackStore
+
+
+def build_parser(env: Mapping[str, str | None]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(
+        description=f"Find and extract archived submissions in the '{PACK_NAME}' of a packed archive."
+    )
+    parser.add_argument(
+        "--base-path",
+        type=str,
+        help="Base path of the packed archive. Defaults to './archive'.",
+        default=env.get("BASE_PATH", str(Path.cwd() / "archive")),
+    )
+    parser.add_argument(
+        "--course",
+        type=str,
+        help="Only courses whose name matches this pattern, like 'Calculus*'. Defaults to all.",
+        default="*",
+    )
+    parser.add_argument(
+        "--assignment",
+        type=str,
+        help="Only assignments whose name matches this pattern. Defaults to all.",
+        default="*",
+    )
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("files", help="List the archived files, with their size.")
+    questions = commands.add_parser(
+        "questions", help="List the questions of the grading panels, with their score."
+    )
+    questions.add_argument("--question", type=int, help="Only the question with this number.")
+    panel = commands.add_parser(
+        "panel", help="Print the grading of one question, read from its grading panel only."
+    )
+    panel.add_argument("--question", type=int, required=True, help="Number of the question.")
+    extract = commands.add_parser(
+        "extract", help="Write the archived files back as a tree of files."
+    )
+    extract.add_argument(
+        "--output",
+        type=str,
+        help="Directory to write the files to. Defaults to the base path, where the pages find their assets.",
+        default=None,
+    )
+    return parser
+
+
+class Arguments:
+    base_path: str
+    course: str
+    assignment: str
+    command: str
+    question: int | None
+    output: str | None
+
+
+def main() -> None:
+    args = build_parser(dotenv.dotenv_values()).parse_args(namespace=Arguments())
+    base_path = Path(args.base_path)
+    if not (base_path / PACK_NAME).is_file():
+        sys.exit(f"No packed archive found in {base_path}, archive with `--store packed` first.")
+    store = PackStore(base_path)
+    try:
+        if args.command == "files":
+            for file in store.files(args.course, args.assignment):
+                print(f"{file.path}\t{file.size}\t{file.stored_size}")
+        elif args.command == "questions":
+            for question in store.questions(args.course, args.assignment, args.question):
+                print(
+                    f"{question.course}\t{question.assignment}\t{question.number}\t"
+                    f"{question.title or ''}\t{question.score or ''}"
+                )
+        elif args.command == "panel":
+            questions = store.questions(args.course, args.assignment, args.question)
+            if not questions:
+                sys.exit("No question matches.")
+            for question in questions:
+                markup = store.read_range(question.path, question.offset, question.length)
+                print(markup.decode("utf-8"))
+        else:
+            output = Path(args.output) if args.output else base_path
+            files = store.files(args.course, args.assignment)
+            for file in files:
+                path = output / file.path
+                path.parent.mkdir(parents=True, exist_ok=True)
+                path.write_bytes(store.read(file.path))
+            print(f"Extracted {len(files)} files to {output}.")
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,234 @@
+import argparse
+import asyncio
+from collections.abc import Awaitable, Callable, Iterator
+from contextlib import contextmanager
+import functools
+import json
+from pathlib import Path
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any
+import urllib.request
+
+from python.src.context import ArchiveContext
+from python.src.fakeans import (
+    SERVING_MESSAGE,
+    add_config_arguments,
+    config_from_arguments,
+    config_to_arguments,
+)
+from python.src.metrics import METRICS
+from python.src.parser import configure_logging, parse_config
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+ENTRY_POINTS = ("python.ans_submissions_archiver", "python.printing_html_files")
+
+
+parser = argparse.ArgumentParser(
+    description="Run the archiver against a local stand-in for ans.app and report its throughput. "
+    "Options that aren't listed here are passed on to the archiver, e.g. '--workers pdfs=8'.",
+)
+parser.add_argument(
+    "--runs",
+    type=int,
+    default=1,
+    help="How often to archive into the same base path, later runs measure the manifest and the http cache. Defaults to 1.",
+)
+parser.add_argument(
+    "--base-path",
+    type=str,
+    default=None,
+    help="Where to archive to. Defaults to a temporary directory that is removed afterwards.",
+)
+parser.add_argument(
+    "--json",
+    type=str,
+    default=None,
+    help="Also write the results of all runs to this file, to compare them between changes.",
+)
+add_config_arguments(parser)
+
+
+def main() -> None:
+    args, archiver_arguments = parser.parse_known_args()
+    config = config_from_arguments(args)
+    base_path = Path(args.base_path or tempfile.mkdtemp(prefix="ans-benchmark-"))
+    try:
+        with fake_ans(config_to_arguments(config)) as base_url:
+            archiver_config = parse_config(
+                [
+                    "--base-url",
+                    base_url,
+                    "--base-path",
+                    str(base_path),
+                    "--ans-token",
+                    "benchmark",
+                    "--user-agent",
+                    "ans-archiver-benchmark",
+                    "--rate-limit",
+                    "0",
+                    "--log-level",
+                    "WARNING",
+                    *archiver_arguments,
+                ]
+            )
+            configure_logging(archiver_config.log_level)
+            from python.src.archiver import archive
+
+            results = []
+            for run in range(1, args.runs + 1):
+                result = asyncio.run(measure(functools.partial(archive, archiver_config), base_url))
+                print(format_result(run, result))
+                results.append(result)
+    finally:
+        if args.base_path is None:
+            shutil.rmtree(base_path, ignore_errors=True)
+    startup = measure_startup()
+    print(
+        "Startup: "
+        + ", ".join(f"{module} --help: {seconds:.2f}s" for module, seconds in startup.items())
+    )
+    if args.json:
+        report = {
+            "config": config._asdict(),
+            "archiver_arguments": archiver_arguments,
+            "runs": results,
+            "startup_seconds": startup,
+        }
+        Path(args.json).write_text(json.dumps(report, indent=2, allow_nan=False), encoding="utf-8")
+
+
+@contextmanager
+def fake_ans(arguments: list[str]) -> Iterator[str]:
+    """
+    Serve the stand-in in its own process on a free port, so its work doesn't count
+    towards the archiver's, and yield its url.
+    """
+    process = subprocess.Popen(
+        [sys.executable, "-m", "python.src.fakeans", "--port", "0", *arguments],
+        stdout=subprocess.PIPE,
+        text=True,
+    )
+    try:
+        assert process.stdout is not None
+        for line in process.stdout:
+            if line.startswith(SERVING_MESSAGE):
+                break
+        else:
+            raise RuntimeError("The fake ANS server exited before it was serving.")
+        yield line.removeprefix(SERVING_MESSAGE).strip()
+    finally:
+        process.terminate()
+        process.wait()
+
+
+def server_stats(base_url: str) -> dict[str, dict[str, int]]:
+    with urllib.request.urlopen(f"{base_url}_stats") as response:
+        return json.load(response)
+
+
+async def measure(
+    archive: Callable[[], Awaitable[ArchiveContext | None]], base_url: str
+) -> dict[str, Any]:
+    before = server_stats(base_url)
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    context = await archive()
+    wall = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    after = server_stats(base_url)
+
+    requests = {
+        name: {
+            key: stats[key] - before.get(name, {}).get(key, 0) for key in ("requests", "bytes")
+        }
+        for name, stats in after.items()
+    }
+    total_requests = sum(stats["requests"] for stats in requests.values())
+    stages: dict[str, Any] = {}
+    if context is not None:
+        cpu_seconds = context.executor.get_stats()
+        stages = {
+            stage: {**stats, "cpu_seconds": cpu_seconds.get(stage, 0.0)}
+            for stage, stats in context.scheduler.get_stats().items()
+        }
+    phases = {
+        histogram["labels"]["phase"]: histogram["sum"]
+        for histogram in METRICS.to_json()["histograms"].get("phase_seconds", [])
+    }
+    return {
+        "wall_seconds": wall,
+        "cpu_seconds": cpu,
+        "peak_rss_bytes": peak_rss(),
+        "requests": total_requests,
+        "requests_per_second": total_requests / wall if wall > 0 else 0.0,
+        "bytes": sum(stats["bytes"] for stats in requests.values()),
+        "requests_by_kind": requests,
+        "stages": stages,
+        "phase_seconds": phases,
+    }
+
+
+def measure_startup(repeat: int = 3) -> dict[str, float]:
+    """
+    Fastest of `repeat` times the entry points took to print their help in a fresh
+    interpreter, which is how long they take before doing any work.
+    """
+    startup = {}
+    for module in ENTRY_POINTS:
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            subprocess.run(
+                [sys.executable, "-m", module, "--help"],
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            times.append(time.perf_counter() - start)
+        startup[module] = min(times)
+    return startup
+
+
+def peak_rss() -> int | None:
+    """
+    Peak resident set size of this process so far in bytes, `None` where it can't be
+    read.
+    """
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS bytes.
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+def format_result(run: int, result: dict[str, Any]) -> str:
+    rss = result["peak_rss_bytes"]
+    lines = [
+        f"Run {run}:",
+        f"  Wall time: {result['wall_seconds']:.2f}s, CPU time: {result['cpu_seconds']:.2f}s",
+        f"  Requests: {result['requests']} ({result['requests_per_second']:.1f}/s), "
+        f"{result['bytes'] / 1024 / 1024:.1f} MB",
+        f"  Peak RSS: {'unknown' if rss is None else f'{rss / 1024 / 1024:.1f} MB'}",
+        "  Requests by kind: "
+        + ", ".join(f"{name}: {stats['requests']}" for name, stats in result["requests_by_kind"].items()),
+        "  Time per phase: "
+        + ", ".join(f"{phase}: {seconds:.2f}s" for phase, seconds in result["phase_seconds"].items()),
+        f"  {'Stage':<12} {'workers':>7} {'jobs':>6} {'busy s':>8} {'cpu s':>8} {'max queued':>10}",
+    ]
+    for stage, stats in result["stages"].items():
+        lines.append(
+            f"  {stage:<12} {stats['workers']:>7} {stats['jobs']:>6} {stats['busy_seconds']:>8.2f}"
+            f" {stats['cpu_seconds']:>8.2f} {stats['max_queued']:>10}"
+        )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    main()
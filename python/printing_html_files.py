@@ -1,52 +1,104 @@
 import argparse
+import asyncio
+from collections.abc import Mapping
+import logging
 import os
 from pathlib import Path
-import subprocess
+import sys
+import time
 import dotenv
 
-config = dotenv.dotenv_values()
 
-
-parser = argparse.ArgumentParser(description="Archive submissions from ANS platform.")
-parser.add_argument(
-    "--base-path",
-    type=str,
-    help="Base path to save the archived submissions. Defaults to './archive'.",
-    default=config.get("BASE_PATH", str(Path.cwd() / "archive")),
-)
-parser.add_argument(
-    "--chrome-executable",
-    type=str,
-    help="Path to theheadless Chrome executable. Defaults to `chrome-headless-shell/*/chrome-headless-shell*`.",
-    default=config.get("CHROME_EXECUTABLE", None),
-)
+def build_parser(env: Mapping[str, str | None]) -> argparse.ArgumentParser:
+    parser = argparse.ArgumentParser(description="Archive submissions from ANS platform.")
+    parser.add_argument(
+        "--base-path",
+        type=str,
+        help="Base path to save the archived submissions. Defaults to './archive'.",
+        default=env.get("BASE_PATH", str(Path.cwd() / "archive")),
+    )
+    parser.add_argument(
+        "--chrome-executable",
+        type=str,
+        help="Path to theheadless Chrome executable. Defaults to `chrome-headless-shell/*/chrome-headless-shell*`.",
+        default=env.get("CHROME_EXECUTABLE", None),
+    )
+    parser.add_argument(
+        "--browsers",
+        type=int,
+        help="Headless Chromes that print at the same time. Defaults to the number of cores.",
+        default=int(env.get("BROWSERS", None) or os.cpu_count() or 1),
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Also print html files whose PDF is newer than the html file.",
+        default=env.get("FORCE", "false").lower() in ("1", "true", "yes"),
+    )
+    return parser
 
 
 class Arguments:
     base_path: str
     chrome_executable: str | None
+    browsers: int
+    force: bool
+
 
+logger = logging.getLogger("ans_archiver")
 
-args = parser.parse_args(namespace=Arguments())
 
-chrome_executable = args.chrome_executable
-if chrome_executable is None:
-    chrome_executables = Path.cwd().glob(
-        "chrome-headless-shell/*/chrome-headless-shell*/chrome-headless-shell*"
+def main() -> None:
+    args = build_parser(dotenv.dotenv_values()).parse_args(namespace=Arguments())
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logger.addHandler(stream_handler)
+    logger.setLevel(logging.INFO)
+
+    chrome_executable = args.chrome_executable
+    if chrome_executable is None:
+        chrome_executables = Path.cwd().glob(
+            "chrome-headless-shell/*/chrome-headless-shell*/chrome-headless-shell*"
+        )
+        chrome_executable = next(chrome_executables, None)
+    if chrome_executable is None or not Path(chrome_executable).is_file():
+        raise FileNotFoundError(
+            "No Chrome executable found. Please specify the path using --chrome-executable or ensure it is located in `chrome-headless-shell/*/chrome-headless-shell*`."
+        )
+    if args.browsers < 1:
+        raise ValueError(f"Browsers must be at least 1. Actual value was: {args.browsers}.")
+
+    # Imported only now, so `--help` doesn't have to wait for aiohttp to load.
+    from python.src.printing import needs_printing, print_files
+
+    base_path = Path(args.base_path)
+    if not base_path.exists() or not base_path.is_dir():
+        raise FileNotFoundError(f"Base path '{base_path}' does not exist.")
+
+    html_files = sorted(base_path.glob("**/*.html"))
+    to_print = [html_file for html_file in html_files if args.force or needs_printing(html_file)]
+    logger.info(
+        f"Printing {len(to_print)} html files, {len(html_files) - len(to_print)} are already printed."
     )
-    chrome_executable = next(chrome_executables, None)
-if chrome_executable is None or not Path(chrome_executable).is_file():
-    raise FileNotFoundError(
-        "No Chrome executable found. Please specify the path using --chrome-executable or ensure it is located in `chrome-headless-shell/*/chrome-headless-shell*`."
+    if not to_print:
+        return
+    start = time.perf_counter()
+    results = asyncio.run(print_files(chrome_executable, to_print, args.browsers))
+    elapsed = time.perf_counter() - start
+    failed = [result for result in results if result.error is not None]
+    printed = len(results) - len(failed)
+    slowest = max(results, key=lambda result: result.seconds)
+    print(
+        f"Printed: {printed}, \n"
+        f"Failed: {len(failed)}, \n"
+        f"Total time: {elapsed:.2f}s, \n"
+        f"Files per second: {len(results) / elapsed if elapsed > 0 else 0.0:.2f}, \n"
+        f"Average time per file: {sum(result.seconds for result in results) / len(results):.2f}s, \n"
+        f"Slowest file: {slowest.html_path} ({slowest.seconds:.2f}s), \n"
     )
+    if failed:
+        sys.exit(1)
 
-base_path = Path(args.base_path)
-if not base_path.exists() or not base_path.is_dir():
-    print(base_path.is_dir)
-    raise FileNotFoundError(f"Base path '{base_path}' does not exist.")
 
-for html_file in base_path.glob("**/*.html"):
-    print(f"Printing html file: {html_file}")
-    os.system(
-        f"{chrome_executable} --headless --no-pdf-header-footer --print-to-pdf={html_file.with_suffix('.pdf')} {html_file}"
-    )
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,110 @@
+import json
+import logging
+from typing import NamedTuple
+
+import aiohttp
+import bs4
+from colorama import Fore
+from yarl import URL
+
+from .manifest import digest_json
+from .utils import AsyncLruCache
+
+logger = logging.getLogger("ans_archiver")
+
+DEFAULT_MAX_UPLOADS = 256
+
+
+class Annotations(NamedTuple):
+    content: dict
+    # Of `content`, what the manifest compares to see whether the annotations changed.
+    digest: str
+
+
+NO_ANNOTATIONS = Annotations({"content": []}, digest_json({"content": []}))
+
+
+class UploadButton(NamedTuple):
+    upload_id: str | None
+    # Empty when the upload has no annotations to fetch.
+    pages_with_annotations: list[int]
+
+
+def index_pdf_buttons(html_soup: bs4.BeautifulSoup) -> dict[str, UploadButton]:
+    """
+    The PDF download buttons of a submission page by their `data-url`, in page order,
+    read in one pass. Buttons for the same file are merged.
+    """
+    buttons: dict[str, UploadButton] = {}
+    pdfs: list[str] = []
+    for button in html_soup.find_all("button", attrs={"data-url": True}):
+        data_url = button["data-url"]
+        if not isinstance(data_url, str):
+            continue
+        upload_id, pages = buttons.get(data_url, UploadButton(None, []))
+        if upload_id is None and button.get("data-upload-id"):
+            upload_id = str(button["data-upload-id"])
+        if not pages and button.has_attr("data-pages-with-annotations"):
+            pages = json.loads(str(button["data-pages-with-annotations"]))
+        buttons[data_url] = UploadButton(upload_id, pages)
+        if (
+            button.get("data-file-type") == "pdf"
+            and button.get("data-file-extension") == ".pdf"
+            and data_url.find("pdf") != -1
+            and data_url not in pdfs
+        ):
+            pdfs.append(data_url)
+    return {data_url: buttons[data_url] for data_url in pdfs}
+
+
+def index_comments(html_soup: bs4.BeautifulSoup) -> dict[str, str | None]:
+    """
+    Text of the point comments on a submission page by annotation uuid, read in one
+    pass for all its PDFs. `None` for comments whose frame has no `<article>`.
+    """
+    comments: dict[str, str | None] = {}
+    for turbo_frame in html_soup.find_all(
+        "turbo-frame", id=lambda x: isinstance(x, str) and x.startswith("annotation_")
+    ):
+        article = turbo_frame.find("article")
+        uuid = str(turbo_frame["id"]).removeprefix("annotation_")
+        comments.setdefault(uuid, None if article is None else article.text.strip())
+    return comments
+
+
+class AnnotationCache:
+    """
+    Annotations of the uploads of one run by upload id, so an upload is fetched and
+    hashed at most once however often it appears. Concurrent requests for an upload
+    share one download, failed downloads aren't remembered.
+
+    Keeps the `max_uploads` most recently used uploads, across runs the http cache
+    revalidates them instead.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        base_url: URL,
+        max_uploads: int = DEFAULT_MAX_UPLOADS,
+    ):
+        self._session = session
+        self._base_url = base_url
+        self._annotations: AsyncLruCache[str, Annotations] = AsyncLruCache(max_uploads)
+
+    async def get(self, upload: UploadButton | None) -> Annotations:
+        if upload is None or upload.upload_id is None or not upload.pages_with_annotations:
+            return NO_ANNOTATIONS
+        upload_id = upload.upload_id
+        return await self._annotations.get(upload_id, lambda: self._fetch(upload_id))
+
+    async def _fetch(self, upload_id: str) -> Annotations:
+        response = await self._session.get(self._base_url / f"uploads/{upload_id}/annotations")
+        try:
+            content = await response.json()
+        except aiohttp.ContentTypeError as e:
+            logger.error(
+                Fore.RED + f"Failed to get annotations JSON\n for: upload ID {upload_id}:\n\n {str(e)}"
+            )
+            return NO_ANNOTATIONS
+        return Annotations(content, digest_json(content))
@@ -0,0 +1,583 @@
+import asyncio
+from collections.abc import AsyncIterator
+import contextlib
+import logging
+from pathlib import Path
+import re
+from typing import NamedTuple, cast
+import aiohttp
+import bs4
+from colorama import Fore
+from yarl import URL
+from .annotations import AnnotationCache
+from .assets import AssetStore
+from .context import ArchiveContext
+from .executor import CpuExecutor
+from .grading import GradingDataWriter
+from .gradingscheme import GradingSchemeSwitch
+from .manifest import Manifest
+from .metrics import METRICS, serve_metrics
+from .packstore import PackStore
+from .pages import PageRegistry
+from .parser import Config
+from .scheduler import Scheduler
+from .submissions import get_submission
+from .throttledclientsession import (
+    DiskCache,
+    MetricsMiddleware,
+    RateLimitMiddleware,
+    ResponseCacheMiddleware,
+    RetryMiddleware,
+)
+from .transport import tcp_connector
+from .utils import merge_async_iterators, sanitize_filename
+from .workqueue import WorkItem, WorkQueue
+
+logger = logging.getLogger("ans_archiver")
+
+
+async def archive(config: Config) -> ArchiveContext | None:
+    """
+    Archive everything the token of `config` can see, returns the context of the run,
+    for its statistics, or `None` if logging in failed.
+    """
+    METRICS.reset(tracing=config.trace_path is not None)
+    throttle_middleware = RateLimitMiddleware(
+        rate_limit=config.rate_limit,
+        jitter_factor=0,
+        burst=config.rate_burst,
+        max_rate_limit=config.max_rate_limit,
+    )
+    retry_middleware = RetryMiddleware(retries=config.retries, budget=config.retry_budget)
+    middlewares: list = [retry_middleware, throttle_middleware, MetricsMiddleware()]
+    if config.http_cache_size > 0:
+        cache_middleware = ResponseCacheMiddleware(
+            DiskCache(config.base_path / ".cache" / "http", config.http_cache_size)
+        )
+        middlewares.insert(1, cache_middleware)
+    store = PackStore(config.base_path) if config.store == "packed" else None
+    manifest = Manifest(config.base_path, store)
+    grading_data = (
+        GradingDataWriter(config.grading_data_path)
+        if config.grading_data_path is not None and config.role != "coordinator"
+        else None
+    )
+    queue = WorkQueue(config.base_path) if config.role != "single" else None
+    if queue is not None and config.role == "coordinator":
+        # Workers wait for the assignments this run lists until it is done.
+        queue.unseal()
+    if queue is None and not config.resume:
+        manifest.clear_journal()
+    context: ArchiveContext | None = None
+    try:
+        # ans.app seems to reject requests otherwise.
+        async with (
+            aiohttp.ClientSession(
+                connector=tcp_connector(config.transport),
+                middlewares=middlewares,
+                headers=config.default_headers,
+                raise_for_status=True,
+                trace_configs=[METRICS.trace_config()],
+            ) as async_session,
+            serve_metrics(config.metrics_port) if config.metrics_port else contextlib.nullcontext(),
+        ):
+            async_session.cookie_jar.update_cookies(
+                {"__Host-ans_session": config.ans_token}, response_url=config.base_url
+            )
+            with CpuExecutor(config.cpu_workers) as executor:
+                pages = PageRegistry(async_session, executor)
+                try:
+                    url = await get_navigation(pages, config.base_url)
+                except (ValueError, *NETWORK_ERRORS) as e:
+                    logger.error(
+                        Fore.RED
+                        + f"Your ANS_TOKEN probably expired, please update it, for the actual error see: {str(e)}"
+                        + Fore.RESET
+                    )
+                    return None
+                if config.year != "latest" and config.year != "all":
+                    query_string = re.sub(r"=\d+$", f"={config.year}", url.query_string)
+                    url = url.with_query(query_string)
+                logger.info(f"Using courses URL: {url}")
+                courses_url = url.relative().with_query({})
+
+                async with Scheduler(config.workers, config.queue_size) as scheduler:
+                    assets = AssetStore(config.base_path, async_session, manifest) if config.mirror_assets else None
+                    context = ArchiveContext(
+                        config,
+                        async_session,
+                        manifest,
+                        scheduler,
+                        executor,
+                        assets,
+                        pages,
+                        AnnotationCache(async_session, config.base_url),
+                        GradingSchemeSwitch(
+                            async_session, pages, config.base_url, config.grading_scheme
+                        ),
+                        store,
+                        grading_data,
+                    )
+                    if queue is not None and config.role == "worker":
+                        await work_off_queue(queue, context, config.base_path)
+                    else:
+                        if queue is not None:
+                            course_job, job_arguments = enqueue_assignments, (queue,)
+                        else:
+                            course_job, job_arguments = get_assignments_from_course, (config.base_path,)
+                        # Courses are archived while the listing is still being read.
+                        pending = [
+                            await scheduler.submit(
+                                "courses",
+                                course_job,
+                                course_info,
+                                context,
+                                courses_url,
+                                *job_arguments,
+                            )
+                            async for course_info in get_courses(pages, url, courses_url, config)
+                        ]
+                        if not pending:
+                            logger.error("No courses found.")
+                        await asyncio.gather(*pending)
+                        if queue is not None:
+                            queue.seal()
+                    if queue is not None:
+                        logger.info(f"Assignments left in the work queue: {queue.unfinished()}.")
+    finally:
+        manifest.close()
+        if store is not None:
+            store.close()
+        if grading_data is not None:
+            grading_data.close()
+        if queue is not None:
+            queue.close()
+    rates = ", ".join(f"{host}: {rate:.2f}" for host, rate in throttle_middleware.get_rates().items())
+    print(METRICS.summary() + f"Current rate per host: {rates}, \n")
+    if config.metrics_path:
+        METRICS.write(config.metrics_path)
+    if config.trace_path:
+        METRICS.write_trace(config.trace_path)
+    return context
+
+
+type Tags = list[bs4.Tag]
+
+
+class CourseInfo(NamedTuple):
+    name: str
+    url: URL
+
+
+type CourseInfos = list[CourseInfo]
+
+
+class AssignmentInfo(NamedTuple):
+    assignment_name: str
+    course_name: str
+    url: URL
+
+
+# Failures that only lose the course or assignment at hand, which is then retried
+# on the next run since it isn't recorded in the manifest.
+NETWORK_ERRORS = (aiohttp.ClientError, asyncio.TimeoutError)
+# How often a worker without work checks whether the assignments of other workers
+# got stuck.
+QUEUE_POLL_SECONDS = 5.0
+
+
+async def get_assignments_from_course(
+    course_info: CourseInfo,
+    context: ArchiveContext,
+    courses_url: URL,
+    base_path: Path,
+) -> None:
+    course_url = str(course_info.url)
+    if context.config.resume and context.manifest.journal_state(course_url) == "done":
+        assignment_infos = [
+            AssignmentInfo(assignment_name=name, course_name=course, url=URL(url))
+            for url, course, name in context.manifest.unfinished_assignments(course_url)
+        ]
+        logger.info(f"Resuming {course_info.name}, {len(assignment_infos)} assignments are left.")
+    else:
+        listed = await list_assignments(course_info, context, courses_url)
+        if listed is None:
+            return
+        assignment_infos = listed
+        for info in assignment_infos:
+            context.manifest.journal(
+                str(info.url), "pending", info.course_name, info.assignment_name, course_url
+            )
+        context.manifest.journal(course_url, "done", course_info.name)
+    pending = [
+        await context.scheduler.submit("assignments", queue_assignment, info, context, base_path)
+        for info in assignment_infos
+    ]
+    submissions = [await future for future in pending]
+    await asyncio.gather(*[future for future in submissions if future is not None])
+
+
+async def enqueue_assignments(
+    course_info: CourseInfo,
+    context: ArchiveContext,
+    courses_url: URL,
+    queue: WorkQueue,
+) -> None:
+    """
+    Put the assignments of a course in the work queue for the worker processes.
+    """
+    assignment_infos = await list_assignments(course_info, context, courses_url) or []
+    queue.enqueue(
+        [WorkItem(str(info.url), info.course_name, info.assignment_name) for info in assignment_infos]
+    )
+
+
+async def list_assignments(
+    course_info: CourseInfo, context: ArchiveContext, courses_url: URL
+) -> list[AssignmentInfo] | None:
+    """
+    The assignments of a course that still have to be archived, `None` if the course
+    couldn't be read.
+    """
+    logger.debug(f"Getting assignments for course {course_info.name} from {course_info.url}.")
+    try:
+        page = await context.pages.get(course_info.url)
+    except NETWORK_ERRORS as e:
+        logger.error(
+            Fore.RED + f"Failed to get assignments of course {course_info.name}, skipping it: {type(e).__name__}: {e}"
+        )
+        return None
+    html_soup = page.soup
+    assignment_infos: list[AssignmentInfo] = [
+        AssignmentInfo(assignment_name=a.text.strip(), course_name=course_info.name, url=URL(href))
+        for a in html_soup.find_all("a")
+        if isinstance(href := a.get("href"), str)
+        and href.startswith(str(courses_url))
+        and href.endswith("go_to")
+    ]
+    logger.debug(f"Found {len(assignment_infos)} assignments for course {course_info.name}.")
+    return assignment_infos
+
+
+async def queue_assignment(
+    info: AssignmentInfo, context: ArchiveContext, base_path: Path
+) -> asyncio.Future | None:
+    """
+    Find the result page of an assignment and queue it for archiving, returns the
+    future of that job or `None` if there is no result page.
+    """
+    if not context.config.refresh and await is_unchanged(info, context):
+        context.manifest.journal(str(info.url), "done")
+        return None
+    try:
+        result_url = await get_result_url(info, context)
+    except NETWORK_ERRORS as e:
+        logger.error(
+            Fore.RED
+            + f"Failed to get assignment {info.course_name}:{info.assignment_name}, skipping it: {type(e).__name__}: {e}"
+        )
+        return None
+    if result_url is None:
+        context.manifest.journal(str(info.url), "done")
+        return None
+    return await context.scheduler.submit(
+        "results",
+        archive_journaled,
+        info,
+        result_url,
+        get_submission_path(info, base_path),
+        context,
+    )
+
+
+async def is_unchanged(info: AssignmentInfo, context: ArchiveContext) -> bool:
+    """
+    Whether an assignment was archived and its result page is still what it was then.
+    The http cache turns asking for the page into a conditional request, so this costs
+    little for assignments nobody touched.
+    """
+    archived = context.manifest.get_archived_result(str(info.url))
+    if archived is None:
+        return False
+    result_url, digest = archived
+    try:
+        # On the configured server, which needn't be the one it was archived from.
+        page = await context.pages.get(context.config.base_url.join(URL(result_url).relative()))
+    except NETWORK_ERRORS as e:
+        logger.warning(
+            f"Failed to revalidate {info.course_name}:{info.assignment_name}, archiving it again: {type(e).__name__}: {e}"
+        )
+        return False
+    if page.digest != digest:
+        logger.info(f"Result page of {info.course_name}:{info.assignment_name} changed, archiving it again.")
+        return False
+    logger.debug(
+        f"Unchanged since archived {info.course_name}:{info.assignment_name}, skipping. Use --refresh to download it again."
+    )
+    return True
+
+
+async def get_result_url(info: AssignmentInfo, context: ArchiveContext) -> URL | None:
+    """
+    Url of the result page of an assignment, `None` if it has none.
+    """
+    page = await context.pages.get(context.config.base_url.join(info.url))
+    assignment_soup = page.soup
+    assignment_results = [
+        URL(href)
+        for a in assignment_soup.find_all("a")
+        if isinstance(href := a.get("href"), str) and href.startswith("/results/")
+    ]
+    if not assignment_results:
+        logger.warning(
+            f"No assignment links found for {info.course_name}:{info.assignment_name} and url was: {info.url}. Skipping."
+        )
+        with open("no_submission_link.html", "w", encoding="utf-8") as f:
+            f.write(str(assignment_soup.prettify()))
+        return None
+
+    assignment_result = assignment_results[0]
+    logger.debug(context.config.base_url.join(assignment_result))
+    return context.config.base_url.join(assignment_result)
+
+
+def get_submission_path(info: AssignmentInfo, base_path: Path) -> Path:
+    course_path = base_path / sanitize_filename(info.course_name)
+    return course_path / sanitize_filename(info.assignment_name)
+
+
+async def archive_assignment(
+    info: AssignmentInfo,
+    result_url: URL,
+    submission_path: Path,
+    context: ArchiveContext,
+) -> bool:
+    """
+    Archive an assignment and record it in the manifest, returns whether it's done,
+    `False` if it failed and should be tried again.
+    """
+    try:
+        with METRICS.span(
+            "assignment", course=info.course_name, assignment=info.assignment_name
+        ):
+            submission = await get_submission(result_url, submission_path, context)
+    except NETWORK_ERRORS as e:
+        logger.error(
+            Fore.RED
+            + f"Failed to archive {info.course_name}:{info.assignment_name}, it will be retried next run: {type(e).__name__}: {e}"
+        )
+        return False
+    if submission is None:
+        return True
+    context.manifest.mark_archived(
+        str(info.url),
+        info.course_name,
+        info.assignment_name,
+        submission_path,
+        str(result_url),
+        submission.id,
+        submission.result_digest,
+    )
+    if context.grading_data is not None:
+        context.grading_data.write(
+            info.course_name, info.assignment_name, submission.id, submission.questions
+        )
+    if context.store is not None:
+        await context.store.pack_directory(
+            submission_path, info.course_name, info.assignment_name, context.executor
+        )
+    return True
+
+
+async def archive_journaled(
+    info: AssignmentInfo,
+    result_url: URL,
+    submission_path: Path,
+    context: ArchiveContext,
+) -> bool:
+    """
+    `archive_assignment`, recording its progress in the journal for `--resume`.
+    """
+    context.manifest.journal(str(info.url), "in_progress")
+    done = await archive_assignment(info, result_url, submission_path, context)
+    if done:
+        context.manifest.journal(str(info.url), "done")
+    return done
+
+
+async def work_off_queue(queue: WorkQueue, context: ArchiveContext, base_path: Path) -> None:
+    """
+    Archive assignments from the work queue until the coordinator sealed it and there
+    are none left that aren't done, also waiting for the ones other workers are busy
+    with, in case they crash.
+    """
+    pending: list[asyncio.Future] = []
+    # Only claimed while a worker is free, so the other processes get their share.
+    slots = asyncio.Semaphore(context.scheduler.get_stats()["assignments"]["workers"])
+    async with queue.keep_leases():
+        while True:
+            await slots.acquire()
+            item = queue.claim()
+            if item is None:
+                slots.release()
+                if queue.is_sealed() and not queue.unfinished():
+                    break
+                await asyncio.sleep(QUEUE_POLL_SECONDS)
+                continue
+            future = await context.scheduler.submit(
+                "assignments", archive_claimed, item, queue, context, base_path
+            )
+            future.add_done_callback(lambda _: slots.release())
+            pending.append(future)
+        await asyncio.gather(*pending)
+
+
+async def archive_claimed(
+    item: WorkItem, queue: WorkQueue, context: ArchiveContext, base_path: Path
+) -> None:
+    info = AssignmentInfo(assignment_name=item.name, course_name=item.course, url=URL(item.url))
+    done = False
+    try:
+        if not context.config.refresh and await is_unchanged(info, context):
+            # Unchanged, or finished by a worker whose lease ran out before it could
+            # say so.
+            done = True
+            return
+        try:
+            result_url = await get_result_url(info, context)
+        except NETWORK_ERRORS as e:
+            logger.error(
+                Fore.RED
+                + f"Failed to get assignment {info.course_name}:{info.assignment_name}, it will be retried: {type(e).__name__}: {e}"
+            )
+            return
+        done = result_url is None or await context.scheduler.run(
+            "results",
+            archive_assignment,
+            info,
+            result_url,
+            get_submission_path(info, base_path),
+            context,
+        )
+    finally:
+        if done:
+            queue.complete(item.url)
+        else:
+            queue.release(item.url)
+
+
+async def get_courses(
+    pages: PageRegistry, url: URL, courses_url: URL, config: Config
+) -> AsyncIterator[CourseInfo]:
+    """
+    Yield the courses of the configured year(s) as soon as their listing page is read,
+    for `--year all` the listings of all years are read concurrently.
+    """
+    seen: set[URL] = set()
+    base_url = config.base_url
+    if config.year != "all":
+        listings = get_list_of_courses(pages, url, courses_url, base_url)
+    else:
+        year_urls = await get_year_urls(pages, url, courses_url, base_url)
+        if year_urls:
+            logger.info(f"Reading the courses of {len(year_urls)} years.")
+            listings = merge_async_iterators(
+                *[
+                    get_list_of_courses(pages, year_url, courses_url, base_url)
+                    for year_url in year_urls
+                ]
+            )
+        else:
+            listings = get_list_of_courses(pages, url.with_query({}), courses_url, base_url)
+    async for course_info in listings:
+        if course_info.url in seen:
+            continue
+        seen.add(course_info.url)
+        yield course_info
+
+
+async def get_year_urls(
+    pages: PageRegistry, url: URL, courses_url: URL, base_url: URL
+) -> list[URL]:
+    """
+    Links to the course listings of the other study years found on the listing of
+    `url`, recognized by the numeric query parameter that selects the year in `url`.
+    """
+    year_keys = {key for key, value in url.query.items() if value.isdigit()}
+    if not year_keys:
+        return []
+    try:
+        page = await pages.get(url)
+    except NETWORK_ERRORS as e:
+        logger.error(Fore.RED + f"Failed to get the list of years from {url}: {type(e).__name__}: {e}")
+        return []
+    html_soup = page.soup
+    year_urls: dict[str, URL] = {}
+    for a in html_soup.find_all("a"):
+        href = a.get("href")
+        if not isinstance(href, str) or not href.startswith(str(courses_url)):
+            continue
+        link = URL(href)
+        for key in year_keys & set(link.query):
+            year = link.query[key]
+            if year.isdigit():
+                year_urls.setdefault(year, base_url.join(link.with_query({key: year})))
+    return list(year_urls.values())
+
+
+async def get_list_of_courses(
+    pages: PageRegistry, url: URL, courses_url: URL, base_url: URL
+) -> AsyncIterator[CourseInfo]:
+    found = 0
+    while True:
+        try:
+            page = await pages.get(url)
+        except NETWORK_ERRORS as e:
+            logger.error(Fore.RED + f"Failed to get courses from {url}: {type(e).__name__}: {e}")
+            return
+
+        html_soup = page.soup
+        courses: CourseInfos = [
+            CourseInfo(name=a.text.strip(), url=base_url.join(URL(href)))
+            for a in html_soup.find_all("a")
+            if isinstance(href := a.get("href"), str) and href.startswith("/routing/courses/")
+        ]
+        next_page = [
+            base_url.join(URL(href))
+            for a in html_soup.find_all("a")
+            if isinstance(href := a.get("href"), str)
+            and href.startswith(str(courses_url))
+            and cast(str, a.text).strip().lower().find("show more") != -1
+        ]
+        logger.info(f"Found {len(courses)} courses on page {url}.")
+        found += len(courses)
+        for course in courses:
+            yield course
+        if not next_page:
+            break
+        url = URL(next_page[0])
+    logger.debug(f"Total courses found on {url}: {found}")
+
+
+async def get_navigation(pages: PageRegistry, base_url: URL) -> URL:
+    page = await pages.get(base_url)
+    html_soup = page.soup
+    navigation_link = [
+        base_url.join(URL(href))
+        for a in html_soup.find_all("a")
+        if isinstance(href := a.get("href"), str)
+        and href.find("courses") != -1
+        and href.find("routing") == -1
+        and not href.startswith("https://")
+    ]
+    if not navigation_link:
+        raise ValueError("No navigation link found.")
+    if len(navigation_link) > 1:
+        logger.warning(
+            Fore.YELLOW + "Multiple navigation links found, taking the first one." + Fore.RESET
+        )
+    navigation_url = navigation_link[0]
+    # .with_query({})
+    # navigation_url = navigation_link[0]
+    return navigation_url
+
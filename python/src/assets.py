@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import mimetypes
+import os
+from pathlib import Path, PurePosixPath
+import re
+
+import aiohttp
+import bs4
+from yarl import URL
+
+from .manifest import Manifest, digest_bytes
+from .utils import atomic_write_bytes
+
+logger = logging.getLogger("ans_archiver")
+
+ASSETS_DIRECTORY = "_assets"
+
+# Attributes that point at something a page needs to render.
+ASSET_ATTRIBUTES = {
+    "link": "href",
+    "script": "src",
+    "img": "src",
+    "source": "src",
+    "video": "poster",
+}
+# `<link>`s that don't load anything, like canonical urls.
+LINK_RELS = {"stylesheet", "icon", "shortcut", "apple-touch-icon", "preload", "modulepreload", "manifest"}
+CSS_URL = re.compile(r"""url\(\s*(['"]?)([^'")]+?)\1\s*\)""")
+CSS_IMPORT = re.compile(r"""@import\s+(['"])([^'"]+)\1""")
+
+
+class AssetStore:
+    """
+    Stylesheets, scripts, fonts and images of archived pages, downloaded once into
+    `BASE_PATH/_assets` under the digest of their content, so pages that share them
+    share one copy. The manifest remembers which url became which file, so later runs
+    don't download them again either.
+
+    Stylesheets are stored with the urls inside them rewritten to the local copies.
+    """
+
+    def __init__(self, base_path: Path, session: aiohttp.ClientSession, manifest: Manifest):
+        self._directory = base_path / ASSETS_DIRECTORY
+        self._session = session
+        self._manifest = manifest
+        self._assets: dict[str, asyncio.Task[str | None]] = {}
+        # Of the stylesheets that are being rewritten, the urls they wait for.
+        self._waiting: dict[str, set[str]] = {}
+
+    async def localize(self, page: bs4.Tag, page_url: URL, page_path: Path) -> None:
+        """
+        Download the assets `page`, or a part of it, refers to and point the references
+        at the local copies, relative to `page_path`. References that can't be downloaded are made
+        absolute, so they keep working online.
+        """
+        references: list[tuple[bs4.Tag, str, URL]] = []
+        for tag in page.find_all(list(ASSET_ATTRIBUTES)):
+            attribute = ASSET_ATTRIBUTES[tag.name]
+            value = tag.get(attribute)
+            if not isinstance(value, str):
+                continue
+            if tag.name == "link" and not LINK_RELS.intersection(tag.get("rel") or []):
+                continue
+            url = _asset_url(page_url, value)
+            if url is not None:
+                references.append((tag, attribute, url))
+        source_sets = [
+            tag for tag in page.find_all(["img", "source"]) if isinstance(tag.get("srcset"), str)
+        ]
+        styles = [style for style in page.find_all("style") if style.string]
+
+        names = await asyncio.gather(
+            *[self.fetch(url) for _, _, url in references],
+            *[self._localize_srcset(tag, page_url, page_path) for tag in source_sets],
+            *[self._rewrite_css(style.string, page_url, page_path.parent) for style in styles],
+        )
+        for (tag, attribute, url), name in zip(references, names):
+            tag[attribute] = self._reference(name, url, page_path.parent)
+            # The local copy differs from what the integrity hash was made for.
+            if name is not None:
+                del tag["integrity"]
+        for style, css in zip(styles, names[len(references) + len(source_sets) :]):
+            style.string = css
+
+    async def fetch(self, url: URL, importers: frozenset[str] = frozenset()) -> str | None:
+        """
+        File name of the local copy of `url` in the store, `None` if it couldn't be
+        downloaded.
+        """
+        key = str(url)
+        task = self._assets.get(key)
+        if key in importers or (task is not None and self._waits_for(key, importers)):
+            # Stylesheets importing each other, the cycle is left to the browser. Also
+            # when another page got to one of them first, waiting for its download
+            # would wait for ourselves.
+            return None
+        if task is None:
+            task = self._assets[key] = asyncio.create_task(self._download(url, importers | {key}))
+        return await asyncio.shield(task)
+
+    def _waits_for(self, key: str, keys: frozenset[str]) -> bool:
+        """
+        Whether the download of `key` waits, directly or through its imports, for one
+        of `keys`.
+        """
+        seen: set[str] = set()
+        stack = [key]
+        while stack:
+            current = stack.pop()
+            if current in keys:
+                return True
+            if current not in seen:
+                seen.add(current)
+                stack.extend(self._waiting.get(current, ()))
+        return False
+
+    async def _download(self, url: URL, importers: frozenset[str]) -> str | None:
+        name = self._manifest.get_asset(str(url))
+        if name is not None and (self._directory / name).is_file():
+            return name
+        try:
+            async with self._session.get(url) as response:
+                data = await response.read()
+                content_type = response.content_type
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning(f"Failed to download asset {url}, linking to it instead: {type(e).__name__}: {e}")
+            return None
+        suffix = PurePosixPath(url.path).suffix.lower()
+        if not suffix or len(suffix) > 8:
+            suffix = mimetypes.guess_extension(content_type) or ""
+        if suffix == ".css" or content_type == "text/css":
+            css = await self._rewrite_css(data.decode("utf-8", errors="replace"), url, None, importers)
+            data = css.encode("utf-8")
+        name = digest_bytes(data) + suffix
+        path = self._directory / name
+        if not path.is_file():
+            atomic_write_bytes(path, data)
+        self._manifest.record_asset(str(url), name)
+        return name
+
+    async def _rewrite_css(
+        self,
+        css: str,
+        css_url: URL,
+        directory: Path | None,
+        importers: frozenset[str] = frozenset(),
+    ) -> str:
+        """
+        `css` with its `url()`s and `@import`s pointing at local copies, relative to
+        `directory`, or to the store itself for stylesheets that are stored in it.
+        """
+        urls = {
+            url
+            for pattern in (CSS_URL, CSS_IMPORT)
+            for match in pattern.finditer(css)
+            if (url := _asset_url(css_url, match.group(2))) is not None
+        }
+        ordered = list(urls)
+        if not importers:
+            names = await asyncio.gather(*[self.fetch(url) for url in ordered])
+        else:
+            # Only stylesheets in the store are waited for by others.
+            key = str(css_url)
+            self._waiting[key] = {str(url) for url in ordered}
+            try:
+                names = await asyncio.gather(*[self.fetch(url, importers) for url in ordered])
+            finally:
+                del self._waiting[key]
+        local = {
+            url: self._reference(name, url, directory if directory is not None else self._directory)
+            for url, name in zip(ordered, names)
+        }
+
+        def replace(match: re.Match) -> str:
+            url = _asset_url(css_url, match.group(2))
+            if url is None:
+                return match.group(0)
+            text = match.group(0)
+            start, end = match.start(2) - match.start(), match.end(2) - match.start()
+            return text[:start] + local[url] + text[end:]
+
+        return CSS_IMPORT.sub(replace, CSS_URL.sub(replace, css))
+
+    async def _localize_srcset(self, tag: bs4.Tag, page_url: URL, page_path: Path) -> None:
+        candidates = []
+        for candidate in str(tag["srcset"]).split(","):
+            value, _, descriptor = candidate.strip().partition(" ")
+            url = _asset_url(page_url, value)
+            candidates.append((value, url, descriptor))
+        names = await asyncio.gather(
+            *[self.fetch(url) for _, url, _ in candidates if url is not None]
+        )
+        name_iter = iter(names)
+        rewritten = []
+        for value, url, descriptor in candidates:
+            if url is not None:
+                value = self._reference(next(name_iter), url, page_path.parent)
+            rewritten.append(f"{value} {descriptor}".strip())
+        tag["srcset"] = ", ".join(rewritten)
+
+    def _reference(self, name: str | None, url: URL, directory: Path) -> str:
+        if name is None:
+            return str(url)
+        return Path(os.path.relpath(self._directory / name, directory)).as_posix()
+
+
+def _asset_url(base: URL, value: str) -> URL | None:
+    value = value.strip()
+    if not value or value.startswith(("data:", "blob:", "javascript:", "#", "about:")):
+        return None
+    try:
+        url = base.join(URL(value))
+    except ValueError:
+        return None
+    if url.scheme not in ("http", "https"):
+        return None
+    return url.with_fragment(None)
@@ -0,0 +1,35 @@
+from typing import NamedTuple
+
+import aiohttp
+
+from .annotations import AnnotationCache
+from .assets import AssetStore
+from .executor import CpuExecutor
+from .grading import GradingDataWriter
+from .gradingscheme import GradingSchemeSwitch
+from .manifest import Manifest
+from .packstore import PackStore
+from .pages import PageRegistry
+from .parser import Config
+from .scheduler import Scheduler
+
+
+class ArchiveContext(NamedTuple):
+    """
+    Everything that is shared by all downloads of one run.
+    """
+
+    config: Config
+    session: aiohttp.ClientSession
+    manifest: Manifest
+    scheduler: Scheduler
+    executor: CpuExecutor
+    # `None` when assets are left on ans.app.
+    assets: AssetStore | None
+    pages: PageRegistry
+    annotations: AnnotationCache
+    grading_scheme: GradingSchemeSwitch
+    # `None` when the archive is left as a tree of files.
+    store: PackStore | None
+    # `None` when the grading of the questions isn't written to a CSV file.
+    grading_data: GradingDataWriter | None
@@ -0,0 +1,25 @@
+import importlib.util
+
+import bs4
+
+from .metrics import METRICS
+
+# lxml parses several times faster than the pure python `html.parser`.
+PAGE_PARSER = "lxml" if importlib.util.find_spec("lxml") is not None else "html.parser"
+
+
+def parse_html(content: str | bytes) -> bs4.BeautifulSoup:
+    """
+    Parse a complete page with the fastest parser available. Parse every response
+    only once and hand the soup to everything that needs it.
+    """
+    with METRICS.timer("parse"):
+        return bs4.BeautifulSoup(content, PAGE_PARSER)
+
+
+def parse_fragment(markup: str) -> bs4.BeautifulSoup:
+    """
+    Parse a snippet that gets inserted into another document, `html.parser` doesn't
+    wrap it in `<html><body>` like lxml does.
+    """
+    return bs4.BeautifulSoup(markup, "html.parser")
@@ -0,0 +1,78 @@
+import asyncio
+import logging
+from pathlib import Path
+import re
+
+import aiohttp
+from aiohttp import hdrs
+from yarl import URL
+
+from .metrics import METRICS, request_kind
+from .throttledclientsession import backoff_delay
+
+logger = logging.getLogger("ans_archiver")
+
+CHUNK_SIZE = 1 << 16
+DOWNLOAD_ATTEMPTS = 5
+
+CONTENT_RANGE_START = re.compile(r"bytes (\d+)-")
+
+
+async def download_to_file(
+    async_session: aiohttp.ClientSession, url: URL, path: Path
+) -> int:
+    """
+    Stream the body of `url` into `path` chunk by chunk, so memory use doesn't depend
+    on the size of the download. Returns the number of bytes written.
+
+    When the connection drops halfway, the download continues where it stopped with a
+    `Range` request, guarded by `If-Range` so a changed file is downloaded anew.
+    """
+    written = 0
+    validator: str | None = None
+    kind = request_kind(url)
+    for attempt in range(1, DOWNLOAD_ATTEMPTS + 1):
+        headers: dict[str, str] = {}
+        if written:
+            headers[hdrs.RANGE] = f"bytes={written}-"
+            if validator:
+                headers[hdrs.IF_RANGE] = validator
+        try:
+            async with async_session.get(url, headers=headers) as response:
+                if written and not _resumes_at(response, written):
+                    logger.debug(f"Server didn't resume {url} at {written} bytes, starting over.")
+                    written = 0
+                validator = _strong_validator(response)
+                with path.open("r+b" if written else "wb") as f:
+                    f.seek(written)
+                    f.truncate()
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        f.write(chunk)
+                        written += len(chunk)
+                        # Streamed bodies bypass the session's trace of received chunks.
+                        METRICS.increment("response_bytes_total", len(chunk), kind=kind)
+            return written
+        except (aiohttp.ClientPayloadError, aiohttp.ClientConnectionError, asyncio.TimeoutError) as e:
+            if attempt == DOWNLOAD_ATTEMPTS:
+                raise
+            delay = backoff_delay(attempt)
+            logger.warning(
+                f"Download of {url} interrupted after {written} bytes ({e!r}), resuming in {delay:.1f}s."
+            )
+            await asyncio.sleep(delay)
+    return written
+
+
+def _resumes_at(response: aiohttp.ClientResponse, offset: int) -> bool:
+    if response.status != 206:
+        return False
+    match = CONTENT_RANGE_START.match(response.headers.get(hdrs.CONTENT_RANGE, ""))
+    return match is not None and int(match.group(1)) == offset
+
+
+def _strong_validator(response: aiohttp.ClientResponse) -> str | None:
+    # `If-Range` only works with strong ETags.
+    etag = response.headers.get(hdrs.ETAG)
+    if etag and not etag.startswith("W/"):
+        return etag
+    return response.headers.get(hdrs.LAST_MODIFIED)
@@ -0,0 +1,49 @@
+import asyncio
+from collections.abc import Callable
+from concurrent.futures import ThreadPoolExecutor
+import functools
+import os
+import time
+from typing import Any
+
+from .scheduler import current_stage
+
+DEFAULT_CPU_WORKERS = min(4, os.cpu_count() or 1)
+
+
+class CpuExecutor:
+    """
+    Runs blocking work (PyMuPDF, parsing and building soups) on a thread pool, so the
+    event loop keeps downloads going in the meantime. PyMuPDF and lxml release the GIL
+    for most of their work, which lets it use more than one core.
+
+    Work handed to it must not mutate anything another thread may be reading.
+    """
+
+    def __init__(self, workers: int = DEFAULT_CPU_WORKERS):
+        self._pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ans-cpu")
+        # CPU seconds spent on behalf of each stage.
+        self._cpu_seconds: dict[str, float] = {}
+
+    def __enter__(self) -> "CpuExecutor":
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self._pool.shutdown(wait=True, cancel_futures=True)
+
+    async def run(self, function: Callable, *args: Any) -> Any:
+        result, cpu_seconds = await asyncio.get_running_loop().run_in_executor(
+            self._pool, functools.partial(_timed, function, *args)
+        )
+        stage = current_stage.get() or "other"
+        self._cpu_seconds[stage] = self._cpu_seconds.get(stage, 0.0) + cpu_seconds
+        return result
+
+    def get_stats(self) -> dict[str, float]:
+        return self._cpu_seconds
+
+
+def _timed(function: Callable, *args: Any) -> tuple[Any, float]:
+    start = time.thread_time()
+    result = function(*args)
+    return result, time.thread_time() - start
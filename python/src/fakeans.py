@@ -0,0 +1,383 @@
+import argparse
+import asyncio
+from collections.abc import Awaitable, Callable
+import hashlib
+import html
+import json
+import sys
+from typing import NamedTuple
+
+from aiohttp import hdrs, web
+import fitz
+
+STUDY_YEAR = 2025
+# Followed by the url, the benchmark waits for this line.
+SERVING_MESSAGE = "Serving fake ANS at "
+PADDING_PARAGRAPH = (
+    "<p>Lorem ipsum dolor sit amet, consectetur adipiscing elit, sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua.</p>\n"
+)
+
+
+ASSETS = {
+    "application.css": (
+        "text/css",
+        b'@font-face { font-family: "Ans"; src: url("/assets/ans.woff2") format("woff2"); }\n'
+        b"body { font-family: Ans, sans-serif; background: url(logo.png) no-repeat; }\n",
+    ),
+    "application.js": ("application/javascript", b"document.documentElement.dataset.ready = 1;\n"),
+    "ans.woff2": ("font/woff2", bytes(range(256)) * 64),
+    "logo.png": ("image/png", b"\x89PNG\r\n\x1a\n" + bytes(1024)),
+}
+
+
+class FakeAnsConfig(NamedTuple):
+    """
+    Shape of the synthetic ANS instance, counts are per parent.
+    """
+
+    courses: int = 4
+    courses_per_page: int = 10
+    assignments: int = 5
+    questions: int = 10
+    pdfs: int = 2
+    pdf_pages: int = 4
+    comments: int = 5
+    drawings: int = 5
+    drawing_points: int = 200
+    page_size: int = 32 * 1024
+    latency: float = 0.0
+
+
+def add_config_arguments(parser: argparse.ArgumentParser) -> None:
+    defaults = FakeAnsConfig()
+    parser.add_argument("--courses", type=int, default=defaults.courses, help="Number of courses.")
+    parser.add_argument(
+        "--courses-per-page",
+        type=int,
+        default=defaults.courses_per_page,
+        help="Courses per page of the course listing, the rest is behind 'Show more'.",
+    )
+    parser.add_argument(
+        "--assignments", type=int, default=defaults.assignments, help="Assignments per course."
+    )
+    parser.add_argument(
+        "--questions", type=int, default=defaults.questions, help="Questions per submission."
+    )
+    parser.add_argument("--pdfs", type=int, default=defaults.pdfs, help="PDFs per submission.")
+    parser.add_argument("--pdf-pages", type=int, default=defaults.pdf_pages, help="Pages per PDF.")
+    parser.add_argument(
+        "--comments", type=int, default=defaults.comments, help="Point comments per PDF."
+    )
+    parser.add_argument(
+        "--drawings", type=int, default=defaults.drawings, help="Drawing annotations per PDF."
+    )
+    parser.add_argument(
+        "--drawing-points",
+        type=int,
+        default=defaults.drawing_points,
+        help="Points per drawing annotation.",
+    )
+    parser.add_argument(
+        "--page-size",
+        type=int,
+        default=defaults.page_size,
+        help="Bytes of filler text added to every html page.",
+    )
+    parser.add_argument(
+        "--latency",
+        type=float,
+        default=defaults.latency,
+        help="Seconds the server waits before answering each request.",
+    )
+
+
+def config_from_arguments(args: argparse.Namespace) -> FakeAnsConfig:
+    return FakeAnsConfig(**{field: getattr(args, field) for field in FakeAnsConfig._fields})
+
+
+def config_to_arguments(config: FakeAnsConfig) -> list[str]:
+    return [
+        item
+        for field, value in config._asdict().items()
+        for item in (f"--{field.replace('_', '-')}", str(value))
+    ]
+
+
+class RequestStats(NamedTuple):
+    requests: int
+    bytes: int
+
+
+class FakeAns:
+    """
+    Stand-in for ans.app that serves generated pages in the shape the archiver scrapes:
+    the home page, paginated course listings, courses, assignments, result pages,
+    submissions (`/grading/view`), question pages, annotations and PDFs.
+
+    Pages are deterministic and carry an ETag, so conditional requests are answered
+    with `304 Not Modified` like the real server does.
+
+    The account starts on the grading panel the archiver calls `new`, the form on the
+    result pages switches it between that and the review panel of `old` for all pages.
+    """
+
+    def __init__(self, config: FakeAnsConfig):
+        self.config = config
+        self._stats: dict[str, list[int]] = {}
+        self._padding = PADDING_PARAGRAPH * max(0, config.page_size // len(PADDING_PARAGRAPH))
+        self._pdf = _generate_pdf(config.pdf_pages)
+        self._review_panel = False
+
+    def application(self) -> web.Application:
+        app = web.Application(middlewares=[self._simulate])
+        app.add_routes(
+            [
+                web.get("/", self.home, name="home"),
+                web.get("/courses", self.courses, name="courses"),
+                web.get("/routing/courses/{course}", self.course, name="course"),
+                web.get(
+                    "/courses/{course}/assignments/{assignment}/go_to",
+                    self.assignment,
+                    name="assignment",
+                ),
+                web.get("/results/{result}", self.result, name="result"),
+                web.post("/grading_scheme", self.switch_grading_scheme, name="switch"),
+                web.get("/results/{result}/grading/view/{page}", self.grading_view, name="grading"),
+                web.get("/uploads/{upload}/annotations", self.annotations, name="annotations"),
+                web.get("/uploads/{upload}/download.pdf", self.pdf, name="pdf"),
+                web.get("/assets/{name}", self.asset, name="asset"),
+                web.get("/_stats", self.stats),
+            ]
+        )
+        return app
+
+    @web.middleware
+    async def _simulate(
+        self, request: web.Request, handler: Callable[[web.Request], Awaitable[web.StreamResponse]]
+    ) -> web.StreamResponse:
+        name = request.match_info.route.name
+        if name is None:
+            return await handler(request)
+        if self.config.latency > 0:
+            await asyncio.sleep(self.config.latency)
+        response = await handler(request)
+        stats = self._stats.setdefault(name, [0, 0])
+        stats[0] += 1
+        if isinstance(response, web.Response) and isinstance(response.body, bytes):
+            stats[1] += len(response.body)
+        return response
+
+    def get_stats(self) -> dict[str, RequestStats]:
+        return {name: RequestStats(*stats) for name, stats in self._stats.items()}
+
+    async def stats(self, request: web.Request) -> web.Response:
+        return web.json_response({name: stats._asdict() for name, stats in self.get_stats().items()})
+
+    def _page(self, request: web.Request, title: str, body: str, head: str = "") -> web.Response:
+        text = (
+            f"<!DOCTYPE html>\n<html><head><title>{html.escape(title)}</title>{head}</head>\n"
+            f"<body>\n{body}\n<div class=\"filler\">{self._padding}</div>\n</body></html>"
+        )
+        return _conditional(request, text.encode("utf-8"), "text/html")
+
+    async def home(self, request: web.Request) -> web.Response:
+        return self._page(
+            request, "ANS", f'<nav><a href="/courses?study_year={STUDY_YEAR}">Courses</a></nav>'
+        )
+
+    async def courses(self, request: web.Request) -> web.Response:
+        page = int(request.query.get("page", "1"))
+        per_page = max(1, self.config.courses_per_page)
+        first = (page - 1) * per_page
+        links = "\n".join(
+            f'<a href="/routing/courses/{course}">Course {course}</a>'
+            for course in range(first, min(first + per_page, self.config.courses))
+        )
+        if first + per_page < self.config.courses:
+            links += f'\n<a href="/courses?study_year={STUDY_YEAR}&amp;page={page + 1}">Show more</a>'
+        return self._page(request, "Courses", links)
+
+    async def course(self, request: web.Request) -> web.Response:
+        course = int(request.match_info["course"])
+        links = "\n".join(
+            f'<a href="/courses/{course}/assignments/{assignment}/go_to">Assignment {assignment}</a>'
+            for assignment in self._assignment_ids(course)
+        )
+        return self._page(request, f"Course {course}", links)
+
+    async def assignment(self, request: web.Request) -> web.Response:
+        assignment = int(request.match_info["assignment"])
+        return self._page(request, "Assignment", f'<a href="/results/{assignment}">Results</a>')
+
+    async def result(self, request: web.Request) -> web.Response:
+        result = int(request.match_info["result"])
+        panel = "data-js-review-panel" if self._review_panel else "data-js-grading-panel"
+        return self._page(
+            request,
+            "Result",
+            f'<a href="/results/{result}/grading/view/{result}">View submission</a>\n'
+            f"<div {panel}></div>\n"
+            '<form class="button_to" method="post" action="/grading_scheme">'
+            '<input type="hidden" name="authenticity_token" value="benchmark"></form>',
+        )
+
+    async def switch_grading_scheme(self, request: web.Request) -> web.Response:
+        if (await request.post()).get("authenticity_token") != "benchmark":
+            raise web.HTTPForbidden()
+        self._review_panel = not self._review_panel
+        return self._page(request, "Result", "Switched")
+
+    async def grading_view(self, request: web.Request) -> web.Response:
+        result = int(request.match_info["result"])
+        page = int(request.match_info["page"])
+        if page == result:
+            return self._submission(request, result)
+        return self._question(request, page)
+
+    def _submission(self, request: web.Request, result: int) -> web.Response:
+        parts = [f'<div data-current-user-id="1" data-assignment-id="{result}">']
+        pages = json.dumps(list(range(1, self.config.pdf_pages + 1)))
+        for upload in self._upload_ids(result):
+            parts.append(
+                f'<button data-file-type="pdf" data-file-extension=".pdf" data-upload-id="{upload}"'
+                f' data-url="/uploads/{upload}/download.pdf?filename=scan_{upload}.pdf"'
+                f" data-pages-with-annotations='{pages}'>Download</button>"
+            )
+            for comment in range(self.config.comments):
+                parts.append(
+                    f'<turbo-frame id="annotation_{upload}-{comment}">'
+                    f"<article>Comment {comment} on upload {upload}</article></turbo-frame>"
+                )
+        parts.append("</div>")
+        for question in range(self.config.questions):
+            parts.append(
+                '<div data-cy="submission-button">'
+                f'<a data-submission-id="{result * 1000 + question + 1}">Question {question + 1}</a></div>'
+            )
+        head = (
+            '<link rel="stylesheet" href="/assets/application.css">'
+            '<script src="/assets/application.js"></script>'
+            '<meta name="csrf-token" content="benchmark">'
+        )
+        return self._page(request, "Submission", "\n".join(parts), head)
+
+    def _question(self, request: web.Request, question: int) -> web.Response:
+        if self._review_panel:
+            body = f"""
+                <div data-js-review-panel>
+                    <div id="question-header"><h3>Question {question}</h3></div>
+                    <div id="criteria">
+                        <div data-js-criterion>Correct approach <span>2 points</span></div>
+                        <div data-js-criterion>Correct answer <span>1 point</span></div>
+                    </div>
+                    <turbo-frame id="adjustment_{question}"><span>No adjustments</span></turbo-frame>
+                    <div class="score-summary">3 / 5</div>
+                </div>
+            """
+            return self._page(request, f"Question {question}", body)
+        body = f"""
+            <div data-js-grading-panel>
+                <!-- QUESTION -->
+                <div class="question"><h3>Question {question}</h3></div>
+                <!-- CRITERIA -->
+                <div class="criteria">
+                    <div class="criterion">Correct approach <span>2 points</span></div>
+                    <div class="criterion">Correct answer <span>1 point</span></div>
+                </div>
+                <!-- POINTS -->
+                <div class="points">3 / 5</div>
+                <div data-js-adjustments-wrapper><span>No adjustments</span></div>
+            </div>
+        """
+        return self._page(request, f"Question {question}", body)
+
+    async def annotations(self, request: web.Request) -> web.Response:
+        upload = int(request.match_info["upload"])
+        pages = max(1, self.config.pdf_pages)
+        content: list[dict] = [
+            {
+                "type": "point",
+                "uuid": f"{upload}-{comment}",
+                "page": comment % pages + 1,
+                "x": 50 + comment * 10,
+                "y": 50 + comment * 10,
+            }
+            for comment in range(self.config.comments)
+        ]
+        content.extend(
+            {
+                "type": "drawing",
+                "page": drawing % pages + 1,
+                "color": "rgba(255, 0, 0, 0.5)",
+                "width": 2,
+                "lines": [
+                    [50 + point % 400, 100 + drawing * 20 + (point * 7) % 30]
+                    for point in range(self.config.drawing_points)
+                ],
+            }
+            for drawing in range(self.config.drawings)
+        )
+        body = json.dumps({"content": content}).encode("utf-8")
+        return _conditional(request, body, "application/json")
+
+    async def asset(self, request: web.Request) -> web.Response:
+        name = request.match_info["name"]
+        if name not in ASSETS:
+            raise web.HTTPNotFound()
+        content_type, body = ASSETS[name]
+        return _conditional(request, body, content_type)
+
+    async def pdf(self, request: web.Request) -> web.Response:
+        return _conditional(request, self._pdf, "application/pdf")
+
+    def _assignment_ids(self, course: int) -> range:
+        return range(course * self.config.assignments, (course + 1) * self.config.assignments)
+
+    def _upload_ids(self, result: int) -> range:
+        return range(result * 100, result * 100 + self.config.pdfs)
+
+
+def _conditional(request: web.Request, body: bytes, content_type: str) -> web.Response:
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    if request.headers.get(hdrs.IF_NONE_MATCH) == etag:
+        return web.Response(status=304, headers={hdrs.ETAG: etag})
+    return web.Response(body=body, content_type=content_type, headers={hdrs.ETAG: etag})
+
+
+def _generate_pdf(pages: int) -> bytes:
+    with fitz.open() as doc:
+        for number in range(1, max(1, pages) + 1):
+            page = doc.new_page()
+            page.insert_text(fitz.Point(72, 72), f"Scanned answer sheet, page {number}")
+        return doc.tobytes()
+
+
+async def serve(config: FakeAnsConfig, host: str, port: int) -> None:
+    runner = web.AppRunner(FakeAns(config).application(), access_log=None)
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    print(f"{SERVING_MESSAGE}http://{host}:{runner.addresses[0][1]}/", flush=True)
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Serve a synthetic stand-in for ans.app.")
+    parser.add_argument("--host", type=str, default="localhost", help="Defaults to 'localhost'.")
+    parser.add_argument(
+        "--port", type=int, default=8080, help="0 picks a free port. Defaults to 8080."
+    )
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    try:
+        asyncio.run(serve(config_from_arguments(args), args.host, args.port))
+    except KeyboardInterrupt:
+        sys.exit(0)
+
+
+if __name__ == "__main__":
+    main()
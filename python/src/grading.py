@@ -0,0 +1,213 @@
+import csv
+from dataclasses import dataclass, field
+import io
+import logging
+import os
+from pathlib import Path
+import re
+
+import bs4
+
+from .utils import atomic_write_bytes
+
+logger = logging.getLogger("ans_archiver")
+
+GRADING_COLUMNS = (
+    "course",
+    "assignment",
+    "submission_id",
+    "question",
+    "subquestion",
+    "kind",
+    "text",
+    "points",
+    "max_points",
+)
+# Points as criteria and adjustments show them, like `2 points`, `-0.5 pt` or `+1`.
+POINTS = re.compile(r"(?:([+-]?\d+(?:[.,]\d+)?)\s*(?:points?|pts?)\b|([+-]\d+(?:[.,]\d+)?)\s*$)", re.I)
+# A score like `3 / 5`.
+SCORE = re.compile(r"([+-]?\d+(?:[.,]\d+)?)\s*/\s*(\d+(?:[.,]\d+)?)")
+
+# Course, assignment and submission id of the rows of a submission.
+type SubmissionKey = tuple[str, str, str]
+
+
+@dataclass(slots=True)
+class Criterion:
+    text: str
+    points: float | None
+
+
+@dataclass(slots=True)
+class Adjustment:
+    text: str
+    points: float | None
+
+
+@dataclass(slots=True)
+class Subquestion:
+    title: str | None
+    criteria: list[Criterion] = field(default_factory=list)
+
+
+@dataclass(slots=True)
+class QuestionGrading:
+    """
+    The grading of one question, as the parsers of the grading panels read it.
+    """
+
+    title: str | None = None
+    # As shown on the page, like `3 / 5`.
+    score: str | None = None
+    points: float | None = None
+    max_points: float | None = None
+    # Criteria of the question itself, the ones below a subquestion are in its own.
+    criteria: list[Criterion] = field(default_factory=list)
+    subquestions: list[Subquestion] = field(default_factory=list)
+    adjustments: list[Adjustment] = field(default_factory=list)
+
+    def set_score(self, score: str | None) -> None:
+        self.score = score
+        match = SCORE.search(score or "")
+        if match:
+            self.points, self.max_points = _number(match.group(1)), _number(match.group(2))
+
+    def add_criteria(self, criteria: list[Criterion]) -> None:
+        """
+        Add `criteria` to the last subquestion, or the question if it has none (yet).
+        """
+        target = self.subquestions[-1].criteria if self.subquestions else self.criteria
+        target.extend(criteria)
+
+
+def element_text(element: bs4.PageElement | None) -> str | None:
+    """
+    Text of `element` with its whitespace collapsed, `None` if there is none.
+    """
+    if element is None:
+        return None
+    return " ".join(element.get_text(" ").split()) or None
+
+
+def parse_points(text: str) -> float | None:
+    match = POINTS.search(text)
+    if match is None:
+        return None
+    return _number(match.group(1) or match.group(2))
+
+
+def _submission_key(course: str, assignment: str, submission_id: object) -> SubmissionKey:
+    # Ids read back from the CSV are text.
+    return course, assignment, str(submission_id)
+
+
+def _number(text: str) -> float:
+    # Dutch pages use a decimal comma.
+    return float(text.replace(",", "."))
+
+
+class GradingDataWriter:
+    """
+    CSV with a row for every question, subquestion, criterion and adjustment of the
+    archived assignments. The `kind` column says which one a row is, questions have
+    their score in `points` and `max_points`.
+
+    Rows are appended as assignments are archived, the rows of earlier runs are kept.
+    An assignment archived again replaces the rows of its submission, the file is
+    rewritten without the replaced ones when the run closes it. Rows that can't be
+    read, like the last one of a run that was killed while writing it, are dropped.
+    """
+
+    def __init__(self, path: Path):
+        self.path = path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._rows: dict[SubmissionKey, list[list]] = {}
+        # Whether the file holds rows of submissions that were archived again since.
+        self._replaced = False
+        is_new = not self._read()
+        if not is_new and self._replaced:
+            # Appending to a cut off line would garble the next row too.
+            self._rewrite()
+            self._replaced = False
+        self._file = open(path, "w" if is_new else "a", newline="", encoding="utf-8")
+        self._writer = csv.writer(self._file)
+        if is_new:
+            self._writer.writerow(GRADING_COLUMNS)
+
+    def _read(self) -> bool:
+        """
+        Read the rows of earlier runs, returns whether there is a file to append to.
+        """
+        if not self.path.is_file():
+            return False
+        with open(self.path, newline="", encoding="utf-8", errors="replace") as f:
+            reader = csv.reader(f)
+            try:
+                if next(reader, None) != list(GRADING_COLUMNS):
+                    return False
+                previous = None
+                for row in reader:
+                    if len(row) != len(GRADING_COLUMNS):
+                        logger.warning(f"Skipping malformed row {reader.line_num} of {self.path}: {row!r}")
+                        self._replaced = True
+                        continue
+                    submission = _submission_key(*row[:3])
+                    # The rows of a submission are written together, rows further down
+                    # are from when it was archived again.
+                    if submission != previous and submission in self._rows:
+                        del self._rows[submission]
+                        self._replaced = True
+                    self._rows.setdefault(submission, []).append(row)
+                    previous = submission
+            except csv.Error as e:
+                logger.warning(f"Skipping the rest of {self.path} from row {reader.line_num}: {e}")
+                self._replaced = True
+        with open(self.path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            # Cut off halfway through a row, appending would continue it.
+            self._replaced |= f.read(1) != b"\n"
+        return True
+
+    def _rewrite(self) -> None:
+        text = io.StringIO(newline="")
+        writer = csv.writer(text)
+        writer.writerow(GRADING_COLUMNS)
+        for rows in self._rows.values():
+            writer.writerows(rows)
+        atomic_write_bytes(self.path, text.getvalue().encode("utf-8"))
+
+    def close(self) -> None:
+        self._file.close()
+        if self._replaced:
+            self._rewrite()
+
+    def write(
+        self, course: str, assignment: str, submission_id: int, questions: list[QuestionGrading]
+    ) -> None:
+        rows = []
+        for number, question in enumerate(questions, 1):
+            key = (course, assignment, submission_id, number)
+            rows.append(
+                (*key, None, "question", question.title, question.points, question.max_points)
+            )
+            rows.extend(
+                (*key, None, "criterion", criterion.text, criterion.points, None)
+                for criterion in question.criteria
+            )
+            for subquestion in question.subquestions:
+                rows.append((*key, subquestion.title, "subquestion", subquestion.title, None, None))
+                rows.extend(
+                    (*key, subquestion.title, "criterion", criterion.text, criterion.points, None)
+                    for criterion in subquestion.criteria
+                )
+            rows.extend(
+                (*key, None, "adjustment", adjustment.text, adjustment.points, None)
+                for adjustment in question.adjustments
+            )
+        submission = _submission_key(course, assignment, submission_id)
+        self._replaced |= submission in self._rows
+        self._rows[submission] = [list(row) for row in rows]
+        self._writer.writerows(rows)
+        # Readable while the run is still going, and complete up to the last assignment
+        # if it is interrupted.
+        self._file.flush()
@@ -0,0 +1,90 @@
+import asyncio
+import logging
+
+import aiohttp
+import bs4
+from colorama import Fore
+from yarl import URL
+
+from .pages import PageRegistry
+from .parser import GradingScheme
+
+logger = logging.getLogger("ans_archiver")
+
+# The panel the result pages show when the account is on a grading scheme.
+SCHEME_PANELS: dict[GradingScheme, str] = {
+    "old": "data-js-review-panel",
+    "new": "data-js-grading-panel",
+}
+
+
+class GradingSchemeSwitch:
+    """
+    Puts the account on the configured grading scheme. The scheme is a preference of the
+    account rather than of an assignment, so it is switched at most once per run: the
+    first result page tells whether the account is on it already, and once switched
+    every later page is.
+
+    The form on the result pages toggles the scheme, so result pages wait while it is
+    being switched instead of switching it back.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        pages: PageRegistry,
+        base_url: URL,
+        scheme: GradingScheme,
+    ):
+        self._session = session
+        self._pages = pages
+        self._base_url = base_url
+        self._panel = SCHEME_PANELS.get(scheme)
+        # Whether the account is known to be on the configured scheme.
+        self._settled = self._panel is None
+        self._lock = asyncio.Lock()
+
+    async def ensure(self, html_soup: bs4.BeautifulSoup, result_url: URL) -> None:
+        """
+        Switch the scheme if the result page `result_url` shows it isn't the configured
+        one, unless that was settled already.
+        """
+        if self._settled:
+            return
+        async with self._lock:
+            if self._settled:
+                return
+            if html_soup.find("div", attrs={self._panel: True}) is None:
+                if not await self._switch(html_soup, result_url):
+                    # Tried again on the next result page, without the form this one
+                    # costs no requests.
+                    return
+                logger.info(f"Switched the grading scheme on {result_url}.")
+            self._settled = True
+
+    async def _switch(self, html_soup: bs4.BeautifulSoup, result_url: URL) -> bool:
+        form = html_soup.find("form", attrs={"class": "button_to", "action": True})
+        if form is None:
+            logger.warning(
+                Fore.RED
+                + f"Grading scheme switch button not found on page: {result_url}. Cannot switch grading schemes."
+            )
+            return False
+        action = form["action"]
+        input_el = form.find("input", attrs={"name": "authenticity_token"})
+        if (
+            input_el is None
+            or not input_el.has_attr("value")
+            or not isinstance(action, str)
+        ):
+            logger.warning(
+                Fore.RED
+                + f"Authenticity token input or action attribute not found in grading scheme switch button on page: {result_url}. Cannot switch grading schemes."
+            )
+            return False
+        raw_body = {"authenticity_token": input_el["value"]}
+        response = await self._session.post(self._base_url.join(URL(action)), data=raw_body)
+        response.release()
+        # Every result page shows the scheme, not only this one.
+        self._pages.clear()
+        return True
@@ -0,0 +1,90 @@
+import gzip
+import logging
+import os
+from pathlib import Path
+from typing import BinaryIO
+
+import bs4
+
+from .manifest import Manifest, digest_file
+from .metrics import METRICS
+from .utils import sibling_temp_path
+
+logger = logging.getLogger("ans_archiver")
+
+# Where the streamed content goes in the skeleton, replaced before anything is written.
+CONTENT_MARKER = "ans-archiver-content"
+BUFFER_SIZE = 1024 * 1024
+
+
+class HtmlStreamWriter:
+    """
+    Writes a page in pieces instead of building and serializing it as one tree: first
+    `skeleton` up to `slot`, then every piece passed to `write`, then the rest of
+    `skeleton`. Nothing is pretty-printed.
+
+    The page is written to a temporary file next to `path`, which only replaces `path`
+    once the page is complete and differs from what the manifest has for `path`. With
+    `compress` it is gzipped to `path` with `.gz` appended.
+    """
+
+    def __init__(
+        self,
+        manifest: Manifest,
+        path: Path,
+        skeleton: bs4.BeautifulSoup,
+        slot: bs4.Tag,
+        compress: bool = False,
+    ):
+        self.path = path.with_name(path.name + ".gz") if compress else path
+        self.written = False
+        # Bytes of the page written so far, before compression.
+        self.size = 0
+        self._manifest = manifest
+        self._compress = compress
+        marker = bs4.Comment(CONTENT_MARKER)
+        slot.append(marker)
+        self._header, self._footer = str(skeleton).split(f"<!--{CONTENT_MARKER}-->", 1)
+        marker.extract()
+        self._tmp_path: Path | None = None
+        self._raw: BinaryIO | None = None
+        self._file: BinaryIO | gzip.GzipFile | None = None
+
+    def __enter__(self) -> "HtmlStreamWriter":
+        self._tmp_path = sibling_temp_path(self.path)
+        self._raw = open(self._tmp_path, "wb", buffering=BUFFER_SIZE)
+        # No timestamp or temporary name in the header, so an unchanged page gives
+        # identical bytes.
+        self._file = (
+            gzip.GzipFile(self.path.stem, "wb", fileobj=self._raw, mtime=0)
+            if self._compress
+            else self._raw
+        )
+        self.write(self._header)
+        return self
+
+    def write(self, markup: str) -> None:
+        assert self._file is not None
+        data = markup.encode("utf-8")
+        with METRICS.timer("write"):
+            self._file.write(data)
+        self.size += len(data)
+
+    def __exit__(self, exc_type: type[BaseException] | None, *exc_info: object) -> None:
+        assert self._file is not None and self._raw is not None and self._tmp_path is not None
+        try:
+            if exc_type is None:
+                self.write(self._footer)
+            self._file.close()
+            self._raw.close()
+            if exc_type is not None:
+                return
+            digest = digest_file(self._tmp_path)
+            if self._manifest.is_intact(self.path, digest):
+                logger.debug(f"Unchanged, not rewriting {self.path}")
+                return
+            os.replace(self._tmp_path, self.path)
+            self._manifest.record_file(self.path, digest)
+            self.written = True
+        finally:
+            self._tmp_path.unlink(missing_ok=True)
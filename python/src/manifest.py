@@ -0,0 +1,300 @@
+import hashlib
+import json
+import logging
+from pathlib import Path
+import sqlite3
+import time
+from typing import TYPE_CHECKING, Literal
+
+from .metrics import METRICS
+from .utils import atomic_write_bytes
+
+if TYPE_CHECKING:
+    from .packstore import PackStore
+
+logger = logging.getLogger("ans_archiver")
+
+MANIFEST_NAME = ".ans_manifest.sqlite3"
+
+type JournalState = Literal["pending", "in_progress", "done"]
+
+
+def digest_bytes(data: bytes) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+
+def digest_file(path: Path) -> str:
+    with path.open("rb") as f:
+        return hashlib.file_digest(f, "sha256").hexdigest()
+
+
+def digest_json(data: object) -> str:
+    return digest_bytes(json.dumps(data, sort_keys=True).encode("utf-8"))
+
+
+class Manifest:
+    """
+    On-disk record of what previous runs archived, stored in `BASE_PATH`.
+
+    Assignments are keyed by their `go_to` url, output files by their path relative
+    to the base path. A file counts as intact when its size and mtime still match the
+    recorded ones, or failing that, when its digest does.
+
+    The journal records how far the current run got, so an interrupted run can be
+    resumed.
+
+    With `store`, files that were moved into the pack store count as intact as long as
+    the store has them with the recorded digest.
+    """
+
+    def __init__(self, base_path: Path, store: "PackStore | None" = None):
+        self._base_path = base_path
+        self._store = store
+        base_path.mkdir(parents=True, exist_ok=True)
+        # Worker processes of a sharded run share the manifest, wait for each other's
+        # writes instead of failing.
+        self._connection = sqlite3.connect(base_path / MANIFEST_NAME, timeout=30)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS assignments (
+                    url TEXT PRIMARY KEY,
+                    course TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    path TEXT NOT NULL,
+                    result_url TEXT,
+                    submission_id INTEGER,
+                    archived_at REAL,
+                    result_digest TEXT
+                );
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    mtime_ns INTEGER NOT NULL,
+                    upload_id TEXT,
+                    annotation_hash TEXT
+                );
+                CREATE TABLE IF NOT EXISTS assets (
+                    url TEXT PRIMARY KEY,
+                    name TEXT NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS journal (
+                    url TEXT PRIMARY KEY,
+                    course_url TEXT,
+                    course TEXT NOT NULL,
+                    name TEXT NOT NULL,
+                    state TEXT NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                """
+            )
+            columns = {row[1] for row in self._connection.execute("PRAGMA table_info(assignments)")}
+            # Manifests of older versions don't remember the result pages yet.
+            if "result_digest" not in columns:
+                self._connection.execute("ALTER TABLE assignments ADD COLUMN result_digest TEXT")
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _key(self, path: Path) -> str:
+        return path.relative_to(self._base_path).as_posix()
+
+    def is_archived(self, url: str) -> bool:
+        row = self._connection.execute(
+            "SELECT path FROM assignments WHERE url = ? AND archived_at IS NOT NULL", (url,)
+        ).fetchone()
+        if row is None:
+            return False
+        directory = self._base_path / row[0]
+        files = self._connection.execute(
+            "SELECT path FROM files WHERE path LIKE ? ESCAPE '\\'",
+            (row[0].replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_") + "/%",),
+        ).fetchall()
+        if not files or (self._store is None and not directory.is_dir()):
+            return False
+        return all(self.is_intact(self._base_path / path) for (path,) in files)
+
+    def get_archived_result(self, url: str) -> tuple[str, str] | None:
+        """
+        Url and digest of the result page of an archived assignment whose files are
+        still intact, to tell whether anything changed since.
+        """
+        if not self.is_archived(url):
+            return None
+        row = self._connection.execute(
+            "SELECT result_url, result_digest FROM assignments WHERE url = ?", (url,)
+        ).fetchone()
+        if row is None or row[0] is None or row[1] is None:
+            return None
+        return row[0], row[1]
+
+    def mark_archived(
+        self,
+        url: str,
+        course: str,
+        name: str,
+        path: Path,
+        result_url: str,
+        submission_id: int,
+        result_digest: str,
+    ) -> None:
+        with self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO assignments VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (
+                    url,
+                    course,
+                    name,
+                    self._key(path),
+                    result_url,
+                    submission_id,
+                    time.time(),
+                    result_digest,
+                ),
+            )
+
+    def is_intact(self, path: Path, digest: str | None = None) -> bool:
+        """
+        Whether `path` still holds what was recorded for it, optionally also requiring
+        the recorded digest to equal `digest`.
+        """
+        row = self._connection.execute(
+            "SELECT digest, size, mtime_ns FROM files WHERE path = ?", (self._key(path),)
+        ).fetchone()
+        if row is None or (digest is not None and row[0] != digest):
+            return False
+        try:
+            stat = path.stat()
+        except FileNotFoundError:
+            return self._store is not None and self._store.contains(path, row[0])
+        if (stat.st_size, stat.st_mtime_ns) == (row[1], row[2]):
+            return True
+        if digest_file(path) != row[0]:
+            return False
+        self.record_file(path, row[0])
+        return True
+
+    def get_upload_id(self, path: Path) -> str | None:
+        """
+        Upload the PDF at `path` was last downloaded from.
+        """
+        row = self._connection.execute(
+            "SELECT upload_id FROM files WHERE path = ?", (self._key(path),)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def is_pdf_unchanged(self, path: Path, upload_id: str, annotation_hash: str) -> bool:
+        row = self._connection.execute(
+            "SELECT upload_id, annotation_hash FROM files WHERE path = ?", (self._key(path),)
+        ).fetchone()
+        if row is None or row != (upload_id, annotation_hash):
+            return False
+        return self.is_intact(path)
+
+    def record_file(
+        self,
+        path: Path,
+        digest: str,
+        upload_id: str | None = None,
+        annotation_hash: str | None = None,
+    ) -> None:
+        stat = path.stat()
+        with self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO files VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(path) DO UPDATE SET
+                    digest = excluded.digest,
+                    size = excluded.size,
+                    mtime_ns = excluded.mtime_ns,
+                    upload_id = COALESCE(excluded.upload_id, files.upload_id),
+                    annotation_hash = COALESCE(excluded.annotation_hash, files.annotation_hash)
+                """,
+                (
+                    self._key(path),
+                    digest,
+                    stat.st_size,
+                    stat.st_mtime_ns,
+                    upload_id,
+                    annotation_hash,
+                ),
+            )
+
+    def get_asset(self, url: str) -> str | None:
+        """
+        Name of the file in the asset store that `url` was saved as.
+        """
+        row = self._connection.execute("SELECT name FROM assets WHERE url = ?", (url,)).fetchone()
+        return None if row is None else row[0]
+
+    def record_asset(self, url: str, name: str) -> None:
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO assets VALUES (?, ?)", (url, name))
+
+    def clear_journal(self) -> None:
+        """
+        Forget the progress of the previous run, when a run starts over.
+        """
+        with self._connection:
+            self._connection.execute("DELETE FROM journal")
+
+    def journal(
+        self,
+        url: str,
+        state: JournalState,
+        course: str = "",
+        name: str = "",
+        course_url: str | None = None,
+    ) -> None:
+        """
+        Record how far the run got with the course or assignment at `url`, courses are
+        `done` once all their assignments are in the journal.
+        """
+        with self._connection:
+            self._connection.execute(
+                """
+                INSERT INTO journal VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    state = excluded.state,
+                    updated_at = excluded.updated_at
+                WHERE excluded.state != 'pending'
+                """,
+                (url, course_url, course, name, state, time.time()),
+            )
+
+    def journal_state(self, url: str) -> JournalState | None:
+        row = self._connection.execute(
+            "SELECT state FROM journal WHERE url = ?", (url,)
+        ).fetchone()
+        return None if row is None else row[0]
+
+    def unfinished_assignments(self, course_url: str) -> list[tuple[str, str, str]]:
+        """
+        Url, course and name of the assignments of a course the journal has that aren't
+        done yet.
+        """
+        return self._connection.execute(
+            """
+            SELECT url, course, name FROM journal
+            WHERE course_url = ? AND state != 'done'
+            ORDER BY rowid
+            """,
+            (course_url,),
+        ).fetchall()
+
+    def write_text(self, path: Path, text: str) -> bool:
+        """
+        Write `text` to `path` unless the file already holds exactly that content.
+        Returns whether the file was written.
+        """
+        data = text.encode("utf-8")
+        digest = digest_bytes(data)
+        if self.is_intact(path, digest):
+            logger.debug(f"Unchanged, not rewriting {path}")
+            return False
+        with METRICS.timer("write"):
+            atomic_write_bytes(path, data)
+        self.record_file(path, digest)
+        return True
@@ -0,0 +1,362 @@
+import bisect
+from collections.abc import AsyncIterator, Awaitable, Callable, Iterator
+from contextlib import asynccontextmanager, contextmanager
+from contextvars import ContextVar
+import functools
+import itertools
+import json
+import re
+import threading
+import time
+from types import SimpleNamespace
+from typing import Any, TypedDict
+
+import aiohttp
+from aiohttp import web
+from yarl import URL
+
+type Labels = tuple[tuple[str, str], ...]
+
+PREFIX = "ans_archiver_"
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+HELP = {
+    "request_seconds": "Time from sending a request until its response headers arrived.",
+    "phase_seconds": "Time spent per phase: waiting on the limiter, the network, parsing html, annotating PDFs and writing files.",
+    "requests_total": "Requests sent to the server, by kind and status.",
+    "response_bytes_total": "Response body bytes received from the server.",
+    "throttled_total": "Responses with 429 or 5xx that slowed the limiter down.",
+    "retries_total": "Requests that were retried.",
+    "retries_exhausted_total": "Failures that weren't retried because the retry budget ran out.",
+    "cache_total": "Responses answered from the http cache, by how.",
+    "connections_total": "Requests by whether they opened a new connection or reused an idle one.",
+}
+
+# What a request fetches, recognized by its path, first match wins.
+REQUEST_KINDS = (
+    ("annotations", re.compile(r"^/uploads/[^/]+/annotations")),
+    ("asset", re.compile(r"^/assets/")),
+    ("grading", re.compile(r"/grading/view")),
+    ("result", re.compile(r"^/results/")),
+    ("assignment", re.compile(r"/go_to$")),
+    ("course", re.compile(r"^/routing/courses/")),
+    ("courses", re.compile(r"^/courses")),
+    ("pdf", re.compile(r"pdf", re.IGNORECASE)),
+    ("home", re.compile(r"^/$")),
+)
+
+
+def request_kind(url: URL) -> str:
+    for kind, pattern in REQUEST_KINDS:
+        if pattern.search(url.path):
+            return kind
+    return "other"
+
+
+class Histogram:
+    """
+    Counts of observations per bucket, Prometheus style: bucket `i` counts the values
+    that are at most `buckets[i]`, the last one the rest.
+    """
+
+    def __init__(self, buckets: tuple[float, ...] = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q: float) -> float:
+        """
+        Upper bound of the bucket that holds the `q`-th quantile. For the last bucket,
+        which has no upper bound, the largest bound there is, so it stays valid JSON.
+        """
+        rank = q * self.count
+        for bound, cumulative in zip(self.buckets, itertools.accumulate(self.counts)):
+            if cumulative >= rank:
+                return bound
+        return self.buckets[-1]
+
+
+class Span(TypedDict):
+    id: int
+    parent: int | None
+    name: str
+    start: float
+    duration: float
+    attributes: dict[str, Any]
+
+
+current_span: ContextVar[int | None] = ContextVar("current_span", default=None)
+
+
+class Metrics:
+    """
+    Counters, latency histograms and optionally a tree of spans of one run, shared by
+    the whole archiver through `METRICS`. Safe to use from the executor threads, spans
+    follow the asyncio context and are only recorded when tracing is enabled.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self, tracing: bool = False) -> None:
+        with self._lock:
+            self._counters: dict[str, dict[Labels, float]] = {}
+            self._histograms: dict[str, dict[Labels, Histogram]] = {}
+            self._spans: list[Span] = []
+            self._span_ids = itertools.count(1)
+            self.tracing = tracing
+            self.start_time = time.time()
+
+    def increment(self, name: str, value: float = 1, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            counter = self._counters.setdefault(name, {})
+            counter[key] = counter.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels: str) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            histograms = self._histograms.setdefault(name, {})
+            histogram = histograms.get(key)
+            if histogram is None:
+                histogram = histograms[key] = Histogram()
+            histogram.observe(value)
+
+    @contextmanager
+    def timer(self, phase: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("phase_seconds", time.perf_counter() - start, phase=phase)
+
+    @contextmanager
+    def span(self, name: str, **attributes: Any) -> Iterator[None]:
+        """
+        Record the enclosed block as a child of the span it runs in.
+        """
+        if not self.tracing:
+            yield
+            return
+        span_id = next(self._span_ids)
+        parent = current_span.get()
+        token = current_span.set(span_id)
+        start = time.time()
+        try:
+            yield
+        finally:
+            current_span.reset(token)
+            with self._lock:
+                self._spans.append(
+                    {
+                        "id": span_id,
+                        "parent": parent,
+                        "name": name,
+                        "start": start,
+                        "duration": time.time() - start,
+                        "attributes": attributes,
+                    }
+                )
+
+    def traced[**P, R](
+        self, name: str
+    ) -> Callable[[Callable[P, Awaitable[R]]], Callable[P, Awaitable[R]]]:
+        """
+        Record every call of the decorated coroutine function as a span.
+        """
+
+        def decorator(function: Callable[P, Awaitable[R]]) -> Callable[P, Awaitable[R]]:
+            @functools.wraps(function)
+            async def wrapper(*args: P.args, **kwargs: P.kwargs) -> R:
+                with self.span(name):
+                    return await function(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def trace_config(self) -> aiohttp.TraceConfig:
+        """
+        Counts the bytes of every response body as they are received, and how many
+        requests needed a new connection.
+        """
+
+        async def on_chunk(
+            session: aiohttp.ClientSession,
+            context: SimpleNamespace,
+            params: aiohttp.TraceResponseChunkReceivedParams,
+        ) -> None:
+            self.increment("response_bytes_total", len(params.chunk), kind=request_kind(params.url))
+
+        async def on_new_connection(
+            session: aiohttp.ClientSession,
+            context: SimpleNamespace,
+            params: aiohttp.TraceConnectionCreateEndParams,
+        ) -> None:
+            self.increment("connections_total", connection="new")
+
+        async def on_reused_connection(
+            session: aiohttp.ClientSession,
+            context: SimpleNamespace,
+            params: aiohttp.TraceConnectionReuseconnParams,
+        ) -> None:
+            self.increment("connections_total", connection="reused")
+
+        trace_config = aiohttp.TraceConfig()
+        trace_config.on_response_chunk_received.append(on_chunk)
+        trace_config.on_connection_create_end.append(on_new_connection)
+        trace_config.on_connection_reuseconn.append(on_reused_connection)
+        return trace_config
+
+    def counter_total(self, name: str, **labels: str) -> float:
+        with self._lock:
+            return sum(
+                value
+                for key, value in self._counters.get(name, {}).items()
+                if set(labels.items()) <= set(key)
+            )
+
+    def to_json(self) -> dict[str, Any]:
+        with self._lock:
+            return {
+                "start_time": self.start_time,
+                "elapsed_seconds": time.time() - self.start_time,
+                "counters": {
+                    name: [{"labels": dict(key), "value": value} for key, value in counter.items()]
+                    for name, counter in self._counters.items()
+                },
+                "histograms": {
+                    name: [
+                        {
+                            "labels": dict(key),
+                            "count": histogram.count,
+                            "sum": histogram.sum,
+                            "buckets": dict(
+                                zip((*map(str, histogram.buckets), "+Inf"), histogram.counts)
+                            ),
+                            "p50": histogram.quantile(0.5),
+                            "p95": histogram.quantile(0.95),
+                        }
+                        for key, histogram in histograms.items()
+                    ]
+                    for name, histograms in self._histograms.items()
+                },
+            }
+
+    def to_prometheus(self) -> str:
+        lines: list[str] = []
+        with self._lock:
+            for name, counter in self._counters.items():
+                lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {PREFIX}{name} counter")
+                for key, value in counter.items():
+                    lines.append(f"{PREFIX}{name}{_format_labels(key)} {_format_value(value)}")
+            for name, histograms in self._histograms.items():
+                lines.append(f"# HELP {PREFIX}{name} {HELP.get(name, name)}")
+                lines.append(f"# TYPE {PREFIX}{name} histogram")
+                for key, histogram in histograms.items():
+                    cumulative = itertools.accumulate(histogram.counts)
+                    for bound, count in zip((*map(str, histogram.buckets), "+Inf"), cumulative):
+                        labels = _format_labels((*key, ("le", bound)))
+                        lines.append(f"{PREFIX}{name}_bucket{labels} {count}")
+                    lines.append(
+                        f"{PREFIX}{name}_sum{_format_labels(key)} {_format_value(histogram.sum)}"
+                    )
+                    lines.append(f"{PREFIX}{name}_count{_format_labels(key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def span_tree(self) -> list[dict[str, Any]]:
+        """
+        The recorded spans as trees, one per span without a parent (an assignment).
+        """
+        with self._lock:
+            nodes = {span["id"]: {**span, "children": []} for span in self._spans}
+        roots = []
+        for node in sorted(nodes.values(), key=lambda node: node["start"]):
+            parent = nodes.get(node["parent"]) if node["parent"] is not None else None
+            (parent["children"] if parent is not None else roots).append(node)
+        return roots
+
+    def summary(self) -> str:
+        with self._lock:
+            phases = {
+                dict(key)["phase"]: histogram
+                for key, histogram in self._histograms.get("phase_seconds", {}).items()
+            }
+        elapsed = time.time() - self.start_time
+        requests = self.counter_total("requests_total")
+        phase_times = ", ".join(
+            f"{phase}: {histogram.sum:.2f}s" for phase, histogram in sorted(phases.items())
+        )
+        return (
+            f"Requests: {requests:g}, \n"
+            f"Requests per second: {requests / elapsed if elapsed > 0 else 0.0:.2f}, \n"
+            f"Received: {self.counter_total('response_bytes_total') / 1024 / 1024:.1f} MB, \n"
+            f"Time per phase: {phase_times}, \n"
+            f"Throttled responses: {self.counter_total('throttled_total'):g}, \n"
+            f"Retried requests: {self.counter_total('retries_total'):g}, \n"
+            f"Failures after the retry budget ran out: {self.counter_total('retries_exhausted_total'):g}, \n"
+            f"Cache revalidated: {self.counter_total('cache_total', result='revalidated'):g}, \n"
+            f"Cache shared in-flight: {self.counter_total('cache_total', result='shared'):g}, \n"
+            f"Cache stored: {self.counter_total('cache_total', result='stored'):g}, \n"
+            f"Connections opened: {self.counter_total('connections_total', connection='new'):g}, "
+            f"reused: {self.counter_total('connections_total', connection='reused'):g}, \n"
+        )
+
+    def write(self, path: str) -> None:
+        """
+        Export to `path`, as JSON if it ends in `.json` and as Prometheus text otherwise.
+        """
+        if path.endswith(".json"):
+            text = json.dumps(self.to_json(), indent=2, allow_nan=False)
+        else:
+            text = self.to_prometheus()
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    def write_trace(self, path: str) -> None:
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(self.span_tree(), f, indent=2, allow_nan=False)
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _format_value(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+METRICS = Metrics()
+
+
+@asynccontextmanager
+async def serve_metrics(port: int) -> AsyncIterator[None]:
+    """
+    Serve the live metrics in Prometheus text format at `/metrics` on `port`.
+    """
+
+    async def handle(request: web.Request) -> web.Response:
+        return web.Response(text=METRICS.to_prometheus(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", handle)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, "localhost", port).start()
+    try:
+        yield
+    finally:
+        await runner.cleanup()
@@ -0,0 +1,269 @@
+from collections.abc import Iterator
+import contextlib
+import hashlib
+import logging
+from pathlib import Path
+import shutil
+import sqlite3
+import tempfile
+import threading
+from typing import IO, TYPE_CHECKING, NamedTuple
+import zlib
+
+if TYPE_CHECKING:
+    from .executor import CpuExecutor
+
+logger = logging.getLogger("ans_archiver")
+
+PACK_NAME = "archive.sqlite3"
+# Files are only stored compressed when that saves at least this fraction, scanned
+# PDFs hardly compress.
+MIN_SAVING = 0.1
+READ_SIZE = 64 * 1024
+# Compressed files up to this size are kept in memory until they are stored.
+SPOOL_SIZE = 4 * 1024 * 1024
+
+
+class PackedFile(NamedTuple):
+    path: str
+    course: str
+    assignment: str
+    # Bytes before compression.
+    size: int
+    stored_size: int
+
+
+class PackedQuestion(NamedTuple):
+    course: str
+    assignment: str
+    # The grading panel the question is in.
+    path: str
+    number: int
+    title: str | None
+    score: str | None
+    # Where the markup of the question is in the uncompressed grading panel.
+    offset: int
+    length: int
+
+
+class PackStore:
+    """
+    Archive in one SQLite database in `BASE_PATH` instead of a tree of files, with an
+    index of the courses, assignments and the questions of every grading panel with
+    their score and where their markup is in the panel.
+
+    Assignments are archived to the tree as usual and moved into the store once they
+    are done. A question is read by decompressing the grading panel up to its end, a
+    file by reading only its own row.
+
+    Files are packed on the executor, so writes to the database hold `_lock`.
+    """
+
+    def __init__(self, base_path: Path):
+        self._base_path = base_path
+        base_path.mkdir(parents=True, exist_ok=True)
+        # Shared by the worker processes of a sharded run like the manifest.
+        self._connection = sqlite3.connect(
+            base_path / PACK_NAME, timeout=30, check_same_thread=False
+        )
+        self._lock = threading.Lock()
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        with self._connection:
+            self._connection.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    course TEXT NOT NULL,
+                    assignment TEXT NOT NULL,
+                    digest TEXT NOT NULL,
+                    size INTEGER NOT NULL,
+                    compressed INTEGER NOT NULL,
+                    data BLOB NOT NULL
+                );
+                CREATE INDEX IF NOT EXISTS files_by_assignment ON files (course, assignment);
+                CREATE TABLE IF NOT EXISTS questions (
+                    path TEXT NOT NULL,
+                    number INTEGER NOT NULL,
+                    title TEXT,
+                    score TEXT,
+                    offset INTEGER NOT NULL,
+                    length INTEGER NOT NULL,
+                    PRIMARY KEY (path, number)
+                );
+                """
+            )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    def _key(self, path: Path) -> str:
+        return path.relative_to(self._base_path).as_posix()
+
+    def contains(self, path: Path, digest: str) -> bool:
+        row = self._connection.execute(
+            "SELECT 1 FROM files WHERE path = ? AND digest = ?", (self._key(path), digest)
+        ).fetchone()
+        return row is not None
+
+    def pack_file(self, path: Path, course: str, assignment: str) -> None:
+        """
+        Move the file at `path` into the store, compressed when that's worth it. Reads,
+        compresses and writes it in chunks, so it runs on the executor and its memory
+        use doesn't depend on the size of the file.
+        """
+        with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as packed:
+            digest, size = _compress(path, packed)
+            compressed = packed.tell() <= size * (1 - MIN_SAVING)
+            if not self.contains(path, digest):
+                with contextlib.ExitStack() as stack:
+                    source = packed if compressed else stack.enter_context(path.open("rb"))
+                    self._put(path, course, assignment, digest, size, compressed, source)
+        path.unlink()
+
+    def _put(
+        self,
+        path: Path,
+        course: str,
+        assignment: str,
+        digest: str,
+        size: int,
+        compressed: bool,
+        source: IO[bytes],
+    ) -> None:
+        source.seek(0, 2)
+        stored_size = source.tell()
+        source.seek(0)
+        with self._lock, self._connection:
+            rowid = self._connection.execute(
+                "INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, zeroblob(?))",
+                (self._key(path), course, assignment, digest, size, compressed, stored_size),
+            ).lastrowid
+            with self._connection.blobopen("files", "data", rowid) as blob:
+                shutil.copyfileobj(source, blob, READ_SIZE)
+
+    def record_questions(
+        self, path: Path, questions: list[tuple[int, str | None, str | None, int, int]]
+    ) -> None:
+        """
+        Replace the index of the grading panel at `path` with `questions`, as number,
+        title, score, offset and length.
+        """
+        key = self._key(path)
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM questions WHERE path = ?", (key,))
+            self._connection.executemany(
+                "INSERT INTO questions VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, *question) for question in questions],
+            )
+
+    def files(self, course: str = "*", assignment: str = "*") -> list[PackedFile]:
+        """
+        Files of the assignments whose course and name match the glob patterns.
+        """
+        return [
+            PackedFile(*row)
+            for row in self._connection.execute(
+                """
+                SELECT path, course, assignment, size, length(data) FROM files
+                WHERE course GLOB ? AND assignment GLOB ?
+                ORDER BY course, assignment, path
+                """,
+                (course, assignment),
+            )
+        ]
+
+    def questions(
+        self, course: str = "*", assignment: str = "*", number: int | None = None
+    ) -> list[PackedQuestion]:
+        return [
+            PackedQuestion(*row)
+            for row in self._connection.execute(
+                """
+                SELECT files.course, files.assignment, questions.path, number, title, score,
+                    offset, length
+                FROM questions JOIN files ON files.path = questions.path
+                WHERE files.course GLOB ? AND files.assignment GLOB ? AND (? IS NULL OR number = ?)
+                ORDER BY files.course, files.assignment, number
+                """,
+                (course, assignment, number, number),
+            )
+        ]
+
+    def read(self, path: str) -> bytes:
+        """
+        The content of the file at `path`, relative to the base path, as it was archived.
+        """
+        return b"".join(self._read_chunks(path))
+
+    def read_range(self, path: str, offset: int, length: int) -> bytes:
+        """
+        `length` bytes at `offset` of the file at `path`, gzipped files are read
+        uncompressed. Nothing after the range is read or decompressed.
+        """
+        chunks = self._read_chunks(path)
+        if path.endswith(".gz"):
+            chunks = _decompressed(chunks, zlib.decompressobj(wbits=31))
+        data = bytearray()
+        for chunk in chunks:
+            data += chunk
+            if len(data) >= offset + length:
+                break
+        return bytes(data[offset : offset + length])
+
+    def _read_chunks(self, path: str) -> Iterator[bytes]:
+        row = self._connection.execute(
+            "SELECT rowid, compressed FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        if row is None:
+            raise KeyError(path)
+        rowid, compressed = row
+        chunks = self._blob_chunks(rowid)
+        return _decompressed(chunks, zlib.decompressobj()) if compressed else chunks
+
+    def _blob_chunks(self, rowid: int) -> Iterator[bytes]:
+        with self._connection.blobopen("files", "data", rowid, readonly=True) as blob:
+            while chunk := blob.read(READ_SIZE):
+                yield chunk
+
+    async def pack_directory(
+        self, directory: Path, course: str, assignment: str, executor: "CpuExecutor"
+    ) -> None:
+        """
+        Move the files of an archived assignment from the tree into the store.
+        """
+        if not directory.is_dir():
+            return
+        for path in sorted(directory.iterdir()):
+            # Temporary files of writes that are still going on.
+            if not path.is_file() or path.name.startswith("."):
+                continue
+            await executor.run(self.pack_file, path, course, assignment)
+        with contextlib.suppress(OSError):
+            directory.rmdir()
+            directory.parent.rmdir()
+        logger.debug(f"Packed {course}:{assignment} into {PACK_NAME}.")
+
+
+def _compress(path: Path, packed: IO[bytes]) -> tuple[str, int]:
+    """
+    Write the file at `path` compressed to `packed`, returns the digest and size of the
+    file.
+    """
+    digest = hashlib.sha256()
+    compressor = zlib.compressobj(6)
+    size = 0
+    with path.open("rb") as f:
+        while chunk := f.read(READ_SIZE):
+            digest.update(chunk)
+            size += len(chunk)
+            packed.write(compressor.compress(chunk))
+    packed.write(compressor.flush())
+    return digest.hexdigest(), size
+
+
+def _decompressed(chunks: Iterator[bytes], decompressor) -> Iterator[bytes]:
+    for chunk in chunks:
+        if data := decompressor.decompress(chunk):
+            yield data
+    if data := decompressor.flush():
+        yield data
@@ -0,0 +1,84 @@
+import re
+from typing import TYPE_CHECKING
+
+import aiohttp
+import bs4
+from yarl import URL
+
+from .dom import parse_html
+from .manifest import digest_bytes
+from .utils import AsyncLruCache
+
+if TYPE_CHECKING:
+    from .executor import CpuExecutor
+
+DEFAULT_MAX_PAGES = 64
+# Tokens the server puts in every response, pages that only differ in these are the
+# same.
+PAGE_TOKENS = re.compile(
+    r'<(?:meta[^>]*name="csrf-(?:param|token)"|input[^>]*name="authenticity_token")[^>]*>'
+)
+
+
+class Page:
+    """
+    A fetched page with its soup, parsed on the executor when it was fetched.
+
+    The soup is shared by everything that gets the page from the registry, so
+    elements that go into a new document must be copied out of it, not moved.
+    """
+
+    def __init__(self, url: URL, text: str, soup: bs4.BeautifulSoup):
+        self.url = url
+        self.text = text
+        self.soup = soup
+
+    @property
+    def digest(self) -> str:
+        """
+        Digest of the page without the tokens that change with every request, to tell
+        whether it changed since an earlier run.
+        """
+        return digest_bytes(PAGE_TOKENS.sub("", self.text).encode("utf-8"))
+
+
+class PageRegistry:
+    """
+    Pages of one run by url, so every page is downloaded and parsed at most once no
+    matter how many parts of the archiver need it. Concurrent requests for a url share
+    one download, failed downloads aren't remembered.
+
+    Keeps the `max_pages` most recently used pages, most pages are only needed by the
+    assignment that is being archived.
+    """
+
+    def __init__(
+        self,
+        session: aiohttp.ClientSession,
+        executor: "CpuExecutor",
+        max_pages: int = DEFAULT_MAX_PAGES,
+    ):
+        self._session = session
+        self._executor = executor
+        self._pages: AsyncLruCache[str, Page] = AsyncLruCache(max_pages)
+
+    async def get(self, url: URL) -> Page:
+        return await self._pages.get(str(url), lambda: self._fetch(url))
+
+    async def _fetch(self, url: URL) -> Page:
+        response = await self._session.get(url)
+        text = await response.text()
+        # Big pages take long enough to parse to hold up every download in between.
+        return Page(url, text, await self._executor.run(parse_html, text))
+
+    def invalidate(self, url: URL) -> None:
+        """
+        Forget `url`, for pages that changed, e.g. after a form was submitted.
+        """
+        self._pages.invalidate(str(url))
+
+    def clear(self) -> None:
+        """
+        Forget all pages, for changes that show on every page.
+        """
+        self._pages.clear()
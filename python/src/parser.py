@@ -1,59 +1,225 @@
 import argparse
-from enum import Enum
+from collections.abc import Mapping, Sequence
 import logging
-import sys
+import os
 from pathlib import Path
-from typing import Literal, get_args
+import sys
+from typing import Literal, NamedTuple, get_args
 import dotenv
 from yarl import URL
-from .utils import URLSession
+from .executor import DEFAULT_CPU_WORKERS
+from .scheduler import Stage, parse_workers
+from .transport import (
+    DEFAULT_CONNECTIONS,
+    DEFAULT_DNS_CACHE_TTL,
+    DEFAULT_KEEPALIVE_TIMEOUT,
+    TransportConfig,
+)
 
-config = dotenv.dotenv_values()
 
+def build_parser(env: Mapping[str, str | None]) -> argparse.ArgumentParser:
+    """
+    The options of the archiver, defaulting to the variables in `env`.
+    """
+    parser = argparse.ArgumentParser(description="Archive submissions from ANS platform.")
+    parser.add_argument(
+        "--year",
+        type=str,
+        help="Year of the courses to archive (e.g., '2023', 'latest', 'all'). Defaults to 'latest'.",
+        default=env.get("YEAR", "latest"),
+    )
+    parser.add_argument(
+        "--base-path",
+        type=str,
+        help="Base path to save the archived submissions. Defaults to './archive'.",
+        default=env.get("BASE_PATH", str(Path.cwd() / "archive")),
+    )
+    parser.add_argument(
+        "--ans-token",
+        type=str,
+        help="ANS session token for authentication.",
+        default=env.get("ANS_TOKEN", ""),
+    )
 
-parser = argparse.ArgumentParser(description="Archive submissions from ANS platform.")
-parser.add_argument(
-    "--year",
-    type=str,
-    help="Year of the courses to archive (e.g., '2023', 'latest', 'all'). Defaults to 'latest'.",
-    default=config.get("YEAR", "latest"),
-)
-parser.add_argument(
-    "--base-path",
-    type=str,
-    help="Base path to save the archived submissions. Defaults to './archive'.",
-    default=config.get("BASE_PATH", str(Path.cwd() / "archive")),
-)
-parser.add_argument(
-    "--ans-token",
-    type=str,
-    help="ANS session token for authentication.",
-    default=config.get("ANS_TOKEN", ""),
-)
+    parser.add_argument(
+        "--grading-scheme",
+        type=str,
+        choices=["old", "new", "current"],
+        help="Grading scheme to use when archiving (e.g., 'old', 'new', 'current'). Defaults to 'current'.",
+        default=env.get("GRADING_SCHEME", "current"),
+    )
+    parser.add_argument(
+        "--log-level",
+        type=str,
+        choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "FATAL", "WARN"],
+        help="Logging level (e.g., 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'). Defaults to 'INFO'.",
+        default=env.get("LOG_LEVEL", "INFO"),
+    )
 
-parser.add_argument(
-    "--grading-scheme",
-    type=str,
-    choices=["old", "new", "current"],
-    help="Grading scheme to use when archiving (e.g., 'old', 'new', 'current'). Defaults to 'current'.",
-    default=config.get("GRADING_SCHEME", "current"),
-)
-parser.add_argument(
-    "--log-level",
-    type=str,
-    choices=["DEBUG", "INFO", "WARNING", "ERROR", "CRITICAL", "FATAL", "WARN"],
-    help="Logging level (e.g., 'DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL'). Defaults to 'INFO'.",
-    default=config.get("LOG_LEVEL", "INFO"),
-)
+    parser.add_argument(
+        "--user-agent",
+        type=str,
+        help="User-Agent associated with the ans token. Authentication won't work otherwise",
+        default=env.get("USER_AGENT", None),
+    )
+    parser.add_argument(
+        "--http-cache-size",
+        type=int,
+        help="Size in MB of the on-disk cache of fetched pages, 0 disables it. Defaults to 256.",
+        default=int(env.get("HTTP_CACHE_SIZE", None) or 256),
+    )
+    parser.add_argument(
+        "--rate-limit",
+        type=float,
+        help="Requests per second per host, the limiter slows down when the server throttles and recovers after. 0 disables it. Defaults to 10.",
+        default=float(env.get("RATE_LIMIT", None) or 10),
+    )
+    parser.add_argument(
+        "--rate-burst",
+        type=int,
+        help="Requests per host that may be sent at once after being idle. Defaults to 1.",
+        default=int(env.get("RATE_BURST", None) or 1),
+    )
+    parser.add_argument(
+        "--max-rate-limit",
+        type=float,
+        help="Requests per second per host the limiter may speed up to while the server keeps up. Defaults to --rate-limit.",
+        default=float(env.get("MAX_RATE_LIMIT", None) or 0) or None,
+    )
+    parser.add_argument(
+        "--retries",
+        type=int,
+        help="How often a failed request is retried. Defaults to 3.",
+        default=int(env.get("RETRIES", None) or 3),
+    )
+    parser.add_argument(
+        "--retry-budget",
+        type=int,
+        help="Retries allowed in total per run, after that failures aren't retried. Defaults to 100.",
+        default=int(env.get("RETRY_BUDGET", None) or 100),
+    )
+    parser.add_argument(
+        "--connections",
+        type=int,
+        help=f"Connections to the server that are kept open at most. Defaults to {DEFAULT_CONNECTIONS}.",
+        default=int(env.get("CONNECTIONS", None) or DEFAULT_CONNECTIONS),
+    )
+    parser.add_argument(
+        "--connections-per-host",
+        type=int,
+        help="Connections to one host that are kept open at most. Defaults to the workers of the stages that send requests.",
+        default=int(env.get("CONNECTIONS_PER_HOST", None) or 0),
+    )
+    parser.add_argument(
+        "--keepalive-timeout",
+        type=float,
+        help=f"Seconds an idle connection is kept open for the next request. Defaults to {DEFAULT_KEEPALIVE_TIMEOUT:g}.",
+        default=float(env.get("KEEPALIVE_TIMEOUT", None) or DEFAULT_KEEPALIVE_TIMEOUT),
+    )
+    parser.add_argument(
+        "--dns-cache-ttl",
+        type=int,
+        help=f"Seconds a resolved host name is reused, 0 resolves it for every new connection. Defaults to {DEFAULT_DNS_CACHE_TTL}.",
+        default=int(env.get("DNS_CACHE_TTL", DEFAULT_DNS_CACHE_TTL) or 0),
+    )
+    parser.add_argument(
+        "--workers",
+        type=str,
+        help="Concurrent workers per stage, e.g. 'pdfs=2,questions=16'. Stages are courses, assignments, results, questions, pdfs and annotations.",
+        default=env.get("WORKERS", ""),
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        help="Maximum number of jobs waiting per stage. Defaults to 16.",
+        default=int(env.get("QUEUE_SIZE", None) or 16),
+    )
+    parser.add_argument(
+        "--cpu-workers",
+        type=int,
+        help=f"Threads for PDF annotation and html processing. Defaults to {DEFAULT_CPU_WORKERS}.",
+        default=int(env.get("CPU_WORKERS", None) or DEFAULT_CPU_WORKERS),
+    )
+    parser.add_argument(
+        "--base-url",
+        type=str,
+        help="Url of the ANS instance to archive from, e.g. a local stand-in for benchmarking. Defaults to 'https://ans.app/'.",
+        default=env.get("BASE_URL", "https://ans.app/"),
+    )
+    parser.add_argument(
+        "--metrics",
+        type=str,
+        help="Write request latencies, bytes and time per phase of the run to this file, as JSON if it ends in '.json' and Prometheus text otherwise.",
+        default=env.get("METRICS", None),
+    )
+    parser.add_argument(
+        "--metrics-port",
+        type=int,
+        help="Serve the metrics live in Prometheus text format at http://localhost:<port>/metrics during the run. 0 disables it. Defaults to 0.",
+        default=int(env.get("METRICS_PORT", None) or 0),
+    )
+    parser.add_argument(
+        "--trace",
+        type=str,
+        help="Write a JSON tree of timed spans per assignment to this file.",
+        default=env.get("TRACE", None),
+    )
+    parser.add_argument(
+        "--no-assets",
+        action="store_true",
+        help="Keep linking to the stylesheets, scripts and images on ans.app instead of saving them in '_assets' in the base path.",
+        default=env.get("NO_ASSETS", "false").lower() in ("1", "true", "yes"),
+    )
+    parser.add_argument(
+        "--role",
+        type=str,
+        choices=["single", "coordinator", "worker"],
+        help="'single' archives everything in this process. 'coordinator' only lists the assignments to archive in a work queue in the base path, that 'worker' processes work off together. Defaults to 'single'.",
+        default=env.get("ROLE", "single"),
+    )
+    parser.add_argument(
+        "--shards",
+        type=int,
+        help="Worker processes that archive at the same time, each one gets its share of the rate limit and retry budget. Defaults to 1.",
+        default=int(env.get("SHARDS", None) or 1),
+    )
+    parser.add_argument(
+        "--compress-html",
+        action="store_true",
+        help="Write 'grading_panel.html' gzipped, as 'grading_panel.html.gz'.",
+        default=env.get("COMPRESS_HTML", "false").lower() in ("1", "true", "yes"),
+    )
+    parser.add_argument(
+        "--store",
+        type=str,
+        choices=["files", "packed"],
+        help="'files' leaves the archive as a tree of files. 'packed' moves every archived assignment into 'archive.sqlite3' in the base path, compressed and indexed by course, assignment and question, see `ans-archiver-lookup`. Defaults to 'files'.",
+        default=env.get("STORE", "files"),
+    )
+    parser.add_argument(
+        "--grading-data",
+        type=str,
+        help="CSV file, relative to the base path, with the questions, criteria, points and adjustments of the archived assignments, every run adds the assignments it archived. Defaults to 'grading.csv', '' to not write it.",
+        default=env.get("GRADING_DATA", "grading.csv"),
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Continue where an interrupted run stopped, courses whose assignments were all listed aren't read again and only their unfinished assignments are archived.",
+        default=env.get("RESUME", "false").lower() in ("1", "true", "yes"),
+    )
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Download assignments that a previous run already archived again, even if their result page is unchanged.",
+        default=env.get("REFRESH", "false").lower() in ("1", "true", "yes"),
+    )
+    return parser
 
-parser.add_argument(
-    "--user-agent",
-    type=str,
-    help="User-Agent associated with the ans token. Authentication won't work otherwise",
-    default=config.get("USER_AGENT", None),
-)
 
 type GradingScheme = Literal["old", "new", "current"]
+type Role = Literal["single", "coordinator", "worker"]
+type Store = Literal["files", "packed"]
 grading_schemes = get_args(GradingScheme.__value__)
 
 
@@ -64,6 +230,31 @@ class Arguments:
     grading_scheme: GradingScheme = "current"
     log_level: str
     user_agent: str
+    refresh: bool
+    http_cache_size: int
+    workers: str
+    queue_size: int
+    cpu_workers: int
+    rate_limit: float
+    rate_burst: int
+    max_rate_limit: float | None
+    retries: int
+    retry_budget: int
+    connections: int
+    connections_per_host: int
+    keepalive_timeout: float
+    dns_cache_ttl: int
+    base_url: str
+    metrics: str | None
+    metrics_port: int
+    trace: str | None
+    no_assets: bool
+    compress_html: bool
+    role: Role
+    resume: bool
+    shards: int
+    store: Store
+    grading_data: str
 
 
 def parse_ans_token(token: str) -> str:
@@ -76,43 +267,135 @@ def parse_ans_token(token: str) -> str:
     return token.split(";", 1)[0]
 
 
-args = parser.parse_args(namespace=Arguments())
-if args.ans_token:
-    ANS_TOKEN = parse_ans_token(args.ans_token)
-else:
-    raise ValueError(
-        f"ANS_TOKEN not found in environment variables, found {args.ans_token} and .env file was: {config}."
-    )
-BASE_PATH = Path(args.base_path)
-if args.year not in ["latest", "all"] and not args.year.isdigit():
-    raise ValueError(
-        f"Year must be 'latest', 'all' or a specific year like '2023'. Actual value was: {args.year}. `.env` file was: {config}."
-    )
-YEAR = args.year
-if args.grading_scheme not in grading_schemes:
-    raise ValueError(
-        f"Invalid grading scheme '{args.grading_scheme}'. Must be one of {grading_schemes}. `.env` file was: {config}."
-    )
-if args.user_agent:
-    USER_AGENT = args.user_agent
-else:
-    raise ValueError(
-        f"USER_AGENT not found in environment variables, found {args.user_agent} and .env file was: {config}, user agent is required for authentication to work."
-    )
-GRADING_SCHEME = args.grading_scheme
+class Config(NamedTuple):
+    """
+    Everything the archiver is configured with, from the command line and `.env`.
+    """
+
+    ans_token: str
+    user_agent: str
+    base_url: URL
+    base_path: Path
+    year: str
+    grading_scheme: GradingScheme
+    log_level: str
+    refresh: bool
+    resume: bool
+    # Bytes.
+    http_cache_size: int
+    workers: dict[Stage, int]
+    queue_size: int
+    cpu_workers: int
+    # Limits of this process, its share of the ones that were configured.
+    rate_limit: float
+    rate_burst: int
+    max_rate_limit: float | None
+    retries: int
+    retry_budget: int
+    transport: TransportConfig
+    role: Role
+    shards: int
+    metrics_path: str | None
+    metrics_port: int
+    trace_path: str | None
+    mirror_assets: bool
+    compress_html: bool
+    store: Store
+    grading_data_path: Path | None
 
+    @property
+    def default_headers(self) -> dict[str, str]:
+        return {"User-Agent": self.user_agent}
 
-SESSION = URLSession()
 
-BASE_URL = URL("https://ans.app/")
-DEFAULT_HEADERS = {"User-Agent": USER_AGENT}
-SESSION.headers.update(DEFAULT_HEADERS)
+def parse_config(argv: Sequence[str] | None = None) -> Config:
+    """
+    Read the configuration from `argv`, by default the command line, with defaults
+    from `.env` in the working directory.
+    """
+    env = dotenv.dotenv_values()
+    args = build_parser(env).parse_args(argv, namespace=Arguments())
+    if not args.ans_token:
+        raise ValueError(
+            f"ANS_TOKEN not found in environment variables, found {args.ans_token} and .env file was: {env}."
+        )
+    if args.year not in ["latest", "all"] and not args.year.isdigit():
+        raise ValueError(
+            f"Year must be 'latest', 'all' or a specific year like '2023'. Actual value was: {args.year}. `.env` file was: {env}."
+        )
+    if args.grading_scheme not in grading_schemes:
+        raise ValueError(
+            f"Invalid grading scheme '{args.grading_scheme}'. Must be one of {grading_schemes}. `.env` file was: {env}."
+        )
+    if not args.user_agent:
+        raise ValueError(
+            f"USER_AGENT not found in environment variables, found {args.user_agent} and .env file was: {env}, user agent is required for authentication to work."
+        )
+    workers = parse_workers(args.workers)
+    if args.queue_size < 1:
+        raise ValueError(f"Queue size must be at least 1. Actual value was: {args.queue_size}.")
+    if args.cpu_workers < 1:
+        raise ValueError(f"CPU workers must be at least 1. Actual value was: {args.cpu_workers}.")
+    if args.rate_burst < 1:
+        raise ValueError(f"Rate burst must be at least 1. Actual value was: {args.rate_burst}.")
+    if args.shards < 1:
+        raise ValueError(f"Shards must be at least 1. Actual value was: {args.shards}.")
+    if args.resume and args.role != "single":
+        raise ValueError(
+            f"--resume only applies to --role single, the work queue of '{args.role}' already continues where it stopped."
+        )
+    if args.connections < 1:
+        raise ValueError(f"Connections must be at least 1. Actual value was: {args.connections}.")
+    grading_data_path = Path(args.base_path) / args.grading_data if args.grading_data else None
+    if grading_data_path is not None and args.role == "worker":
+        # Every worker process writes the assignments it archived to a file of its own.
+        grading_data_path = grading_data_path.with_stem(f"{grading_data_path.stem}-{os.getpid()}")
+    base_url = URL(args.base_url)
+    if not base_url.is_absolute():
+        raise ValueError(f"Base url must be an absolute url like 'https://ans.app/'. Actual value was: {args.base_url}.")
+    return Config(
+        ans_token=parse_ans_token(args.ans_token),
+        user_agent=args.user_agent,
+        base_url=base_url,
+        base_path=Path(args.base_path),
+        year=args.year,
+        grading_scheme=args.grading_scheme,
+        log_level=args.log_level,
+        refresh=args.refresh,
+        resume=args.resume,
+        http_cache_size=args.http_cache_size * 1024 * 1024,
+        workers=workers,
+        queue_size=args.queue_size,
+        cpu_workers=args.cpu_workers,
+        # The limits hold for all worker processes together.
+        rate_limit=args.rate_limit / args.shards,
+        rate_burst=args.rate_burst,
+        max_rate_limit=args.max_rate_limit / args.shards if args.max_rate_limit else None,
+        retries=max(0, args.retries),
+        retry_budget=max(0, args.retry_budget) // args.shards,
+        transport=TransportConfig(
+            connections=args.connections,
+            # As many as the stages that send requests can use at once.
+            connections_per_host=args.connections_per_host
+            or sum(count for stage, count in workers.items() if stage != "annotations"),
+            keepalive_timeout=args.keepalive_timeout,
+            dns_cache_ttl=args.dns_cache_ttl if args.dns_cache_ttl > 0 else None,
+        ),
+        role=args.role,
+        shards=args.shards,
+        metrics_path=args.metrics,
+        metrics_port=args.metrics_port,
+        trace_path=args.trace,
+        mirror_assets=not args.no_assets,
+        compress_html=args.compress_html,
+        store=args.store,
+        grading_data_path=grading_data_path,
+    )
 
-# Keep cookie names aligned with browser traffic.
-SESSION.cookies.set("__Host-ans_session", ANS_TOKEN, domain="ans.app", path="/")
 
-logger = logging.getLogger("ans_archiver")
-stream_handler = logging.StreamHandler(sys.stdout)
-stream_handler.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
-logger.addHandler(stream_handler)
-logger.setLevel(logging._nameToLevel[args.log_level.upper()])
+def configure_logging(log_level: str) -> None:
+    logger = logging.getLogger("ans_archiver")
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(levelname)s:%(message)s"))
+    logger.addHandler(stream_handler)
+    logger.setLevel(logging._nameToLevel[log_level.upper()])
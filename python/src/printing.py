@@ -0,0 +1,231 @@
+import asyncio
+import base64
+import itertools
+import json
+import logging
+from pathlib import Path
+import re
+import shutil
+import tempfile
+import time
+from typing import Any, NamedTuple
+
+import aiohttp
+
+from .utils import atomic_write_bytes
+
+logger = logging.getLogger("ans_archiver")
+
+DEVTOOLS_URL = re.compile(r"DevTools listening on (ws://\S+)")
+STARTUP_TIMEOUT = 30.0
+PAGE_TIMEOUT = 60.0
+
+
+class ChromeError(Exception):
+    pass
+
+
+class ChromeBrowser:
+    """
+    One long-lived headless Chrome, driven over the DevTools protocol on a websocket.
+    Every page is printed in a fresh tab, so the browser is only started once.
+    """
+
+    def __init__(self, executable: str | Path):
+        self._executable = str(executable)
+        self._ids = itertools.count(1)
+        self._pending: dict[int, asyncio.Future[dict[str, Any]]] = {}
+        self._waiters: dict[tuple[str | None, str], asyncio.Future[dict[str, Any]]] = {}
+        self._process: asyncio.subprocess.Process | None = None
+        self._session: aiohttp.ClientSession | None = None
+        self._websocket: aiohttp.ClientWebSocketResponse | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._user_data_dir = ""
+
+    @property
+    def alive(self) -> bool:
+        return (
+            self._process is not None
+            and self._process.returncode is None
+            and self._websocket is not None
+            and not self._websocket.closed
+        )
+
+    async def start(self) -> None:
+        self._user_data_dir = tempfile.mkdtemp(prefix="ans-chrome-")
+        self._process = await asyncio.create_subprocess_exec(
+            self._executable,
+            "--headless",
+            "--remote-debugging-port=0",
+            f"--user-data-dir={self._user_data_dir}",
+            "--no-first-run",
+            "--no-default-browser-check",
+            "about:blank",
+            stdout=asyncio.subprocess.DEVNULL,
+            stderr=asyncio.subprocess.PIPE,
+        )
+        url = await asyncio.wait_for(self._devtools_url(), STARTUP_TIMEOUT)
+        self._session = aiohttp.ClientSession()
+        self._websocket = await self._session.ws_connect(url, max_msg_size=0)
+        self._tasks.append(asyncio.create_task(self._read()))
+
+    async def _devtools_url(self) -> str:
+        assert self._process is not None and self._process.stderr is not None
+        stderr = self._process.stderr
+        async for line in stderr:
+            match = DEVTOOLS_URL.search(line.decode(errors="replace"))
+            if match:
+                # Chrome blocks once the pipe is full, keep it drained.
+                self._tasks.append(asyncio.create_task(self._drain(stderr)))
+                return match.group(1)
+        raise ChromeError(f"{self._executable} exited before the DevTools protocol was available.")
+
+    async def _drain(self, stream: asyncio.StreamReader) -> None:
+        async for line in stream:
+            logger.debug(f"chrome: {line.decode(errors='replace').rstrip()}")
+
+    async def _read(self) -> None:
+        assert self._websocket is not None
+        try:
+            async for message in self._websocket:
+                if message.type != aiohttp.WSMsgType.TEXT:
+                    continue
+                data = json.loads(message.data)
+                if "id" in data:
+                    future = self._pending.pop(data["id"], None)
+                    if future is None or future.done():
+                        continue
+                    if "error" in data:
+                        future.set_exception(ChromeError(data["error"].get("message", data["error"])))
+                    else:
+                        future.set_result(data.get("result", {}))
+                    continue
+                waiter = self._waiters.pop((data.get("sessionId"), data.get("method")), None)
+                if waiter is not None and not waiter.done():
+                    waiter.set_result(data.get("params", {}))
+        finally:
+            error = ChromeError("The connection to Chrome was closed.")
+            for future in [*self._pending.values(), *self._waiters.values()]:
+                if not future.done():
+                    future.set_exception(error)
+            self._pending.clear()
+            self._waiters.clear()
+
+    async def send(
+        self, method: str, params: dict[str, Any] | None = None, session_id: str | None = None
+    ) -> dict[str, Any]:
+        if not self.alive:
+            raise ChromeError("Chrome is not running.")
+        assert self._websocket is not None
+        message_id = next(self._ids)
+        message: dict[str, Any] = {"id": message_id, "method": method, "params": params or {}}
+        if session_id is not None:
+            message["sessionId"] = session_id
+        future = asyncio.get_running_loop().create_future()
+        self._pending[message_id] = future
+        await self._websocket.send_json(message)
+        return await future
+
+    def expect(self, method: str, session_id: str | None = None) -> asyncio.Future[dict[str, Any]]:
+        """
+        Future of the next `method` event, to be created before the command that causes it.
+        """
+        future = asyncio.get_running_loop().create_future()
+        self._waiters[(session_id, method)] = future
+        return future
+
+    async def print_to_pdf(self, html_path: Path, pdf_path: Path) -> None:
+        target = await self.send("Target.createTarget", {"url": "about:blank"})
+        target_id = target["targetId"]
+        try:
+            attached = await self.send("Target.attachToTarget", {"targetId": target_id, "flatten": True})
+            session_id = attached["sessionId"]
+            await self.send("Page.enable", session_id=session_id)
+            loaded = self.expect("Page.loadEventFired", session_id)
+            await self.send("Page.navigate", {"url": html_path.resolve().as_uri()}, session_id)
+            await asyncio.wait_for(loaded, PAGE_TIMEOUT)
+            result = await self.send(
+                "Page.printToPDF",
+                {"displayHeaderFooter": False, "transferMode": "ReturnAsBase64"},
+                session_id,
+            )
+        finally:
+            if self.alive:
+                await self.send("Target.closeTarget", {"targetId": target_id})
+        # Never leave a half-written PDF behind at `pdf_path`.
+        atomic_write_bytes(pdf_path, base64.b64decode(result["data"]))
+
+    async def close(self) -> None:
+        if self._websocket is not None:
+            await self._websocket.close()
+        if self._session is not None:
+            await self._session.close()
+        if self._process is not None and self._process.returncode is None:
+            self._process.terminate()
+            try:
+                await asyncio.wait_for(self._process.wait(), 10)
+            except asyncio.TimeoutError:
+                self._process.kill()
+                await self._process.wait()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        shutil.rmtree(self._user_data_dir, ignore_errors=True)
+
+
+class PrintResult(NamedTuple):
+    html_path: Path
+    seconds: float
+    error: str | None = None
+
+
+def needs_printing(html_path: Path) -> bool:
+    """
+    Whether `html_path` has no PDF next to it yet that is newer than itself.
+    """
+    pdf_path = html_path.with_suffix(".pdf")
+    try:
+        return pdf_path.stat().st_mtime < html_path.stat().st_mtime
+    except FileNotFoundError:
+        return True
+
+
+async def print_files(
+    executable: str | Path, html_paths: list[Path], browsers: int
+) -> list[PrintResult]:
+    """
+    Print every file of `html_paths` to a PDF next to it, on a pool of `browsers`
+    headless Chromes that each print one page at a time.
+    """
+    queue: asyncio.Queue[Path] = asyncio.Queue()
+    for html_path in html_paths:
+        queue.put_nowait(html_path)
+    results: list[PrintResult] = []
+
+    async def work() -> None:
+        browser = ChromeBrowser(executable)
+        try:
+            await browser.start()
+            while not queue.empty():
+                html_path = queue.get_nowait()
+                if not browser.alive:
+                    logger.warning("Chrome stopped, starting a new one.")
+                    await browser.close()
+                    browser = ChromeBrowser(executable)
+                    await browser.start()
+                start = time.perf_counter()
+                try:
+                    await browser.print_to_pdf(html_path, html_path.with_suffix(".pdf"))
+                except (ChromeError, asyncio.TimeoutError, aiohttp.ClientError, OSError) as e:
+                    result = PrintResult(html_path, time.perf_counter() - start, f"{type(e).__name__}: {e}")
+                    logger.error(f"Failed to print {html_path}: {result.error}")
+                else:
+                    result = PrintResult(html_path, time.perf_counter() - start)
+                    logger.info(f"Printed {html_path} in {result.seconds:.2f}s")
+                results.append(result)
+        finally:
+            await browser.close()
+
+    await asyncio.gather(*[work() for _ in range(max(1, min(browsers, len(html_paths))))])
+    return results
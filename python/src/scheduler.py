@@ -0,0 +1,177 @@
+import asyncio
+from collections import deque
+from collections.abc import AsyncIterator, Callable, Iterable
+from contextvars import Context, ContextVar, copy_context
+import inspect
+import logging
+import time
+from typing import Any, Literal, TypedDict, get_args
+
+logger = logging.getLogger("ans_archiver")
+
+type Stage = Literal["courses", "assignments", "results", "questions", "pdfs", "annotations"]
+stages: tuple[Stage, ...] = get_args(Stage.__value__)
+
+# The stage whose job is running, for attributing work done on its behalf.
+current_stage: ContextVar[Stage | None] = ContextVar("current_stage", default=None)
+
+
+class StageStats(TypedDict):
+    workers: int
+    jobs: int
+    busy_seconds: float
+    max_queued: int
+
+
+DEFAULT_WORKERS: dict[Stage, int] = {
+    "courses": 2,
+    "assignments": 4,
+    "results": 4,
+    "questions": 8,
+    "pdfs": 4,
+    "annotations": 2,
+}
+
+
+def parse_workers(spec: str) -> dict[Stage, int]:
+    """
+    Parse worker counts like `pdfs=2,questions=16`, stages that are left out keep
+    their default.
+    """
+    workers = dict(DEFAULT_WORKERS)
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        stage, _, count = item.partition("=")
+        stage = stage.strip()
+        if stage not in stages or not count.strip().isdigit() or int(count) < 1:
+            raise ValueError(
+                f"Invalid worker count '{item}', expected <stage>=<count> with count >= 1 and stage one of {stages}."
+            )
+        workers[stage] = int(count)
+    return workers
+
+
+class StageQueue:
+    """
+    Bounded queue of jobs for one stage of the archiver, worked off by a fixed number
+    of workers. Submitting waits while the queue is full.
+    """
+
+    def __init__(self, name: Stage, workers: int, queue_size: int):
+        self.name = name
+        self._workers = workers
+        self._queue: asyncio.Queue[tuple[Callable, tuple, asyncio.Future, Context]] = (
+            asyncio.Queue(maxsize=queue_size)
+        )
+        self._tasks: list[asyncio.Task] = []
+        self._stats: StageStats = {
+            "workers": workers,
+            "jobs": 0,
+            "busy_seconds": 0.0,
+            "max_queued": 0,
+        }
+
+    def start(self) -> None:
+        self._tasks = [
+            asyncio.create_task(self._work(), name=f"{self.name}-worker-{i}")
+            for i in range(self._workers)
+        ]
+
+    async def stop(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def submit(self, function: Callable, *args: Any) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        # Jobs run in the context they were submitted from, so spans nest across stages.
+        await self._queue.put((function, args, future, copy_context()))
+        self._stats["max_queued"] = max(self._stats["max_queued"], self._queue.qsize())
+        return future
+
+    async def _work(self) -> None:
+        while True:
+            function, args, future, context = await self._queue.get()
+            start = time.perf_counter()
+            try:
+                if future.cancelled():
+                    continue
+                context.run(current_stage.set, self.name)
+                result = context.run(function, *args)
+                if inspect.iscoroutine(result):
+                    result = await asyncio.create_task(result, context=context)
+                elif inspect.isawaitable(result):
+                    result = await result
+            except asyncio.CancelledError:
+                future.cancel()
+                raise
+            except Exception as e:
+                if not future.done():
+                    future.set_exception(e)
+            else:
+                if not future.done():
+                    future.set_result(result)
+            finally:
+                self._stats["jobs"] += 1
+                self._stats["busy_seconds"] += time.perf_counter() - start
+                self._queue.task_done()
+
+    def get_stats(self) -> StageStats:
+        return self._stats
+
+
+class Scheduler:
+    """
+    One `StageQueue` per stage. Jobs of a stage may wait on jobs of later stages,
+    never on jobs of their own stage, so the workers can't deadlock.
+    """
+
+    def __init__(self, workers: dict[Stage, int], queue_size: int):
+        self._stages = {
+            stage: StageQueue(stage, workers.get(stage, DEFAULT_WORKERS[stage]), queue_size)
+            for stage in stages
+        }
+
+    async def __aenter__(self) -> "Scheduler":
+        for stage in self._stages.values():
+            stage.start()
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        await asyncio.gather(*[stage.stop() for stage in self._stages.values()])
+
+    async def submit(self, stage: Stage, function: Callable, *args: Any) -> asyncio.Future:
+        """
+        Queue `function(*args)` on `stage`, waiting for room in the queue. The returned
+        future resolves to its result.
+        """
+        return await self._stages[stage].submit(function, *args)
+
+    async def run(self, stage: Stage, function: Callable, *args: Any) -> Any:
+        return await (await self.submit(stage, function, *args))
+
+    async def map(self, stage: Stage, function: Callable, arguments: Iterable[tuple]) -> list:
+        """
+        Queue `function` for each tuple of arguments one after another, so only as many
+        jobs exist as the queue has room for, and gather the results in order.
+        """
+        futures = [await self.submit(stage, function, *args) for args in arguments]
+        return await asyncio.gather(*futures)
+
+    async def imap(
+        self, stage: Stage, function: Callable, arguments: Iterable[tuple]
+    ) -> AsyncIterator:
+        """
+        Like `map`, but yield each result in order as soon as it and the ones before it
+        are done, while the remaining jobs are still being queued.
+        """
+        futures: deque[asyncio.Future] = deque()
+        for args in arguments:
+            futures.append(await self.submit(stage, function, *args))
+            while futures and futures[0].done():
+                yield futures.popleft().result()
+        while futures:
+            yield await futures.popleft()
+
+    def get_stats(self) -> dict[Stage, StageStats]:
+        return {name: stage.get_stats() for name, stage in self._stages.items()}
@@ -1,30 +1,57 @@
 import asyncio
+from collections import Counter
 from collections.abc import Callable
-import json
+import copy
+import functools
 import logging
+import os
 from pprint import pprint
-from typing import NamedTuple, cast
-import aiohttp
-from color_parser_py import ColorParser
+from typing import TYPE_CHECKING, NamedTuple
 from colorama import Fore
 import bs4
 from yarl import URL
 from pathlib import Path
-import fitz
 
-from .utils import sanitize_filename
-from .parser import BASE_PATH, BASE_URL, GRADING_SCHEME
+from .annotations import UploadButton, index_comments, index_pdf_buttons
+from .context import ArchiveContext
+from .dom import parse_fragment, parse_html
+from .downloads import download_to_file
+from .grading import (
+    Adjustment,
+    Criterion,
+    QuestionGrading,
+    Subquestion,
+    element_text,
+    parse_points,
+)
+from .htmlstream import HtmlStreamWriter
+from .manifest import digest_file
+from .metrics import METRICS
+from .utils import remove_stale_parts, sanitize_filename, sibling_temp_path
+
+if TYPE_CHECKING:
+    import fitz
 
 logger = logging.getLogger("ans_archiver")
 
 
+class Submission(NamedTuple):
+    id: int
+    # In the order of the grading panel.
+    questions: list[QuestionGrading]
+    # Of the result page, see `Page.digest`.
+    result_digest: str
+
+
 async def get_submission(
-    url: URL, submission_path: Path, async_session: aiohttp.ClientSession
-) -> None:
+    url: URL, submission_path: Path, context: ArchiveContext
+) -> Submission | None:
+    """
+    Archive the submission behind the result page `url`, returns it or `None` if there
+    is nothing to archive (yet).
+    """
     logger.debug(f"Getting submission for url: {url} and saving to {submission_path}")
-    result = await async_session.get(str(url))
-    content = await result.text()
-    html_soup = bs4.BeautifulSoup(content, "html.parser")
+    html_soup = (await context.pages.get(url)).soup
     submission_links = [
         URL(href)
         for a in html_soup.find_all("a")
@@ -34,125 +61,150 @@ async def get_submission(
         # There are no results so we don't have to download this one.
         logger.warning(
             Fore.YELLOW
-            + f"No submission links found, url: {url} for assignment {submission_path.relative_to(BASE_PATH)}"
+            + f"No submission links found, url: {url} for assignment {submission_path.relative_to(context.config.base_path)}"
         )
-        return
-    switch_to_old = GRADING_SCHEME == "old" and not html_soup.find(
-        "div", attrs={"data-js-review-panel": True}
-    )
-    switch_to_new = GRADING_SCHEME == "new" and not html_soup.find(
-        "div", attrs={"data-js-grading-panel": True}
-    )
-    if switch_to_old or switch_to_new:
-        await switch_grading_schemes(async_session, html_soup, url)
+        return None
+    await context.grading_scheme.ensure(html_soup, url)
+    # Read again only if switching the grading scheme changed it.
+    result_digest = (await context.pages.get(url)).digest
 
     # Multiple links are expected, I think one for each question but not sure.
     # elif len(submission_links) > 1:
     #     print("Multiple submission links found, taking the first one.")
     submission_link = submission_links[0]
-    await get_answers(BASE_URL.join(submission_link), submission_path, async_session)
+    return await get_answers(
+        context.config.base_url.join(submission_link), submission_path, result_digest, context
+    )
 
 
 async def get_answers(
-    url: URL, path: Path, async_session: aiohttp.ClientSession
-) -> None:
+    url: URL, path: Path, result_digest: str, context: ArchiveContext
+) -> Submission:
     url_no_query = url.with_query({})
     id = int(url_no_query.parts[-1])
     url_with_no_id = url_no_query.parent
     logger.debug(f"Getting answers for {url_with_no_id} with id {id}")
-    await download_answers(url_with_no_id, id, path, async_session)
+    questions = await download_answers(url_with_no_id, id, path, context)
+    return Submission(id, questions, result_digest)
+
+
+def pdf_filenames(uploads: dict[str, UploadButton]) -> dict[str, str]:
+    """
+    File names of the PDFs of a submission by their `data-url`, as the server names
+    them. Names that more than one upload has get the upload id added.
+    """
+    filenames = {
+        data_url: sanitize_filename(
+            URL(data_url, encoded=True).query.get("filename", "faulty_name.pdf")
+        )
+        for data_url in uploads
+    }
+    counts = Counter(filenames.values())
+    for number, (data_url, filename) in enumerate(filenames.items(), 1):
+        if counts[filename] > 1:
+            stem, suffix = os.path.splitext(filename)
+            upload_id = uploads[data_url].upload_id or str(number)
+            filenames[data_url] = sanitize_filename(f"{stem}_{upload_id}{suffix}")
+    return filenames
 
 
 async def download_submission(
-    text: str, path: Path, async_session: aiohttp.ClientSession
+    html_soup: bs4.BeautifulSoup, page_url: URL, path: Path, context: ArchiveContext
 ) -> None:
-    html_soup = bs4.BeautifulSoup(text, "html.parser")
-    new_html_page = create_answer_html(html_soup)
+    new_html_page = await context.executor.run(create_answer_html, html_soup)
     main_tag = new_html_page.main
     body_tag = new_html_page.body
     new_html = new_html_page.page
     attempt = html_soup.find(
         "div", attrs={"data-current-user-id": True, "data-assignment-id": True}
     )
-    pdf_buttons = [
-        button["data-url"]
-        for button in html_soup.find_all("button")
-        if button.get("data-file-type") == "pdf"
-        and button.get("data-file-extension") == ".pdf"
-        and button.get("data-url", "").find("pdf") != -1
-    ]
-    if not pdf_buttons and not isinstance(attempt, bs4.element.Tag):
+    uploads = index_pdf_buttons(html_soup)
+    if not uploads and not isinstance(attempt, bs4.element.Tag):
         print("No PDF download links found and no submission attempt.")
-        with (path / "no_attempt.html").open("w", encoding="utf-8") as f:
-            f.write(str(html_soup.prettify()))
+        context.manifest.write_text(path / "no_attempt.html", str(html_soup.prettify()))
         return
+    comments = index_comments(html_soup) if uploads else {}
+    filenames = pdf_filenames(uploads)
 
-    async def get_annotations_from_html(url: URL) -> dict:
-        annotation_html = html_soup.find(
-            "button", attrs={"data-pages-with-annotations": True, "data-url": str(url)}
-        )
-        if annotation_html is None:
-            return {"content": []}
-
-        pages_with_annotations = json.loads(
-            cast(str, annotation_html["data-pages-with-annotations"])
-        )
-        if not pages_with_annotations:
-            return {"content": []}
-        data_upload_id = annotation_html["data-upload-id"]
-        annotation_response = await async_session.get(
-            BASE_URL / f"uploads/{data_upload_id}/annotations"
-        )
-        try:
-            annotation_data = await annotation_response.json()
-        except aiohttp.ContentTypeError as e:
-            logger.error(
-                Fore.RED
-                + f"Failed to get annotations JSON\n for Path: {path}\n for: upload ID {data_upload_id}:\n\n {str(e)}"
-            )
-            return {"content": []}
-        return annotation_data
-
-    async def download_pdf(url: URL, path: Path) -> None:
-        pdf_file = await async_session.get(url)
-        filename = sanitize_filename(url.query.get("filename", "faulty_name.pdf"))
+    @METRICS.traced("pdf")
+    async def download_pdf(data_url: str, path: Path) -> None:
+        url = context.config.base_url.join(URL(data_url, encoded=True))
+        filename = filenames[data_url]
         path.mkdir(parents=True, exist_ok=True)
         pdf_path = path / filename
-        content = await pdf_file.read()
-        pdf_document = fitz.Document(stream=content, filetype="pdf")
-        annotation_data = await get_annotations_from_html(url)
-        annotate_pdf(pdf_document, annotation_data, html_soup, pdf_path)
+        upload = uploads[data_url]
+        upload_id = upload.upload_id or url.path
+        # Every PDF of the submission has a name of its own, so nothing else downloads
+        # to `pdf_path` now.
+        remove_stale_parts(pdf_path)
+        download_path = sibling_temp_path(pdf_path, ".part")
+        try:
+            if not context.config.refresh and context.manifest.get_upload_id(pdf_path) == upload_id:
+                # The same upload as last time, only new annotations make it worth
+                # downloading again. `--refresh` downloads it regardless.
+                annotations = await context.annotations.get(upload)
+                if context.manifest.is_pdf_unchanged(pdf_path, upload_id, annotations.digest):
+                    logger.debug(f"Unchanged PDF, skipping download: {pdf_path}")
+                    return
+                await download_to_file(context.session, url, download_path)
+            else:
+                # The annotations are fetched while the PDF is downloaded.
+                annotations, _ = await asyncio.gather(
+                    context.annotations.get(upload),
+                    download_to_file(context.session, url, download_path),
+                )
+            await context.scheduler.run(
+                "annotations",
+                context.executor.run,
+                annotate_pdf_file,
+                download_path,
+                annotations.content,
+                comments,
+                pdf_path,
+            )
+        finally:
+            download_path.unlink(missing_ok=True)
+        context.manifest.record_file(
+            pdf_path, digest_file(pdf_path), upload_id, annotations.digest
+        )
         logger.info(Fore.GREEN + f"Downloaded PDF: {filename}: {pdf_path}")
 
     path.mkdir(parents=True, exist_ok=True)
-    await asyncio.gather(
-        *[
-            download_pdf(BASE_URL.join(URL(pdf_url, encoded=True)), path)
-            for pdf_url in pdf_buttons
-        ]
-    )
+    await context.scheduler.map("pdfs", download_pdf, [(pdf_url, path) for pdf_url in uploads])
     if not isinstance(attempt, bs4.element.Tag):
         return
 
-    main_tag.append(attempt)
+    # Copied, the submission page is shared with the grading panel.
+    main_tag.append(copy.copy(attempt))
     body_tag.append(main_tag)
     body_tag.append(
-        bs4.BeautifulSoup(
-            '<div data-js-i18n data-default-locale="nl" data-locale="nl"></div>',
-            "html.parser",
-        )
+        parse_fragment('<div data-js-i18n data-default-locale="nl" data-locale="nl"></div>')
     )
-    path.mkdir(parents=True, exist_ok=True)
-    with (path / "attempt.html").open("w", encoding="utf-8") as f:
-        f.write(str(new_html))
+    if context.assets is not None:
+        await context.assets.localize(new_html, page_url, path / "attempt.html")
+    context.manifest.write_text(path / "attempt.html", str(new_html))
+
+
+def annotate_pdf_file(
+    source_path: Path, annotations_data: dict, comments: dict[str, str | None], pdf_path: Path
+) -> None:
+    # Imported on first use, it takes long to load and not every run annotates.
+    import fitz
+
+    with METRICS.timer("annotate"), fitz.open(source_path, filetype="pdf") as doc:
+        annotate_pdf(doc, annotations_data, comments, pdf_path)
 
 
 def annotate_pdf(
-    doc: fitz.Document,
+    doc: "fitz.Document",
     annotations_data: dict,
-    html_soup: bs4.BeautifulSoup,
+    comments: dict[str, str | None],
     pdf_path: Path,
 ) -> None:
+    """
+    Add the point comments and drawings of `annotations_data` to `doc`, the text of the
+    point comments is looked up in `comments`, from `index_comments`.
+    """
     annotation_content = annotations_data["content"]
     point_comments = [
         annotation for annotation in annotation_content if annotation["type"] == "point"
@@ -173,17 +225,14 @@ def annotate_pdf(
             [ann["type"] for ann in the_rest],
         )
     for comment in point_comments:
-        turbo_frame = html_soup.find(
-            "turbo-frame", attrs={"id": f"annotation_{comment['uuid']}"}
-        )
-        if turbo_frame is None:
+        if comment["uuid"] not in comments:
             print(
                 Fore.RED
                 + f"Turbo-frame not found for annotation {comment['uuid']} in {pdf_path}. Skipping annotation."
             )
             continue
-        article = turbo_frame.find("article")
-        if article is None:
+        text = comments[comment["uuid"]]
+        if text is None:
             print(
                 Fore.RED
                 + f"Article not found in turbo-frame for annotation {comment['uuid']} in {pdf_path}. Skipping annotation."
@@ -197,15 +246,16 @@ def annotate_pdf(
             )
             continue
         page = doc[page_count - 1]
-        point = fitz.Point(comment["x"], comment["y"])
-        annot = page.add_text_annot(point, article.text.strip())
+        annot = page.add_text_annot((comment["x"], comment["y"]), text)
         annot.set_name("Comment")
         info = annot.info
         info["title"] = "Annotation from ANS"
         annot.set_info(info)
         annot.update()
 
-    # Process drawing annotations
+    # Process drawing annotations, one shape per page so each page's content stream is
+    # only rewritten once, with one polyline per stroke.
+    drawings_by_page: dict[int, list[dict]] = {}
     for drawing in drawings:
         page_num: int = drawing["page"]
         if page_num > len(doc):
@@ -214,28 +264,48 @@ def annotate_pdf(
                 + f"Annotation page {page_num} exceeds document page count {len(doc)}. Skipping annotation.\n {pdf_path}"
             )
             continue
-        page = doc[page_num - 1]
-        lines: list[list[float]] = drawing["lines"]
-        try:
-            colors = ColorParser(drawing["color"]).rgba_float
-            color = colors[0:3]
-            opacity = colors[3] if len(colors) > 3 else 1.0
-        except ValueError:
-            print(f"Can't parse drawing color: {drawing['color']}")
-            # Default to black if color parsing fails
-            color = (0.0, 0.0, 0.9)
-            opacity = 1.0
-        width: int = drawing["width"]
-
-        # Draw lines by connecting consecutive points
-        for i in range(len(lines) - 1):
-            point1 = fitz.Point(*lines[i])
-            point2 = fitz.Point(*lines[i + 1])
-            page.draw_line(
-                point1, point2, color=color, width=width, stroke_opacity=opacity
+        drawings_by_page.setdefault(page_num, []).append(drawing)
+    for page_num, page_drawings in drawings_by_page.items():
+        shape = doc[page_num - 1].new_shape()
+        for drawing in page_drawings:
+            lines: list[list[float]] = drawing["lines"]
+            if len(lines) < 2:
+                continue
+            color, opacity = parse_drawing_color(drawing["color"])
+            shape.draw_polyline(lines)
+            # Round joins, sharp turns of a pen stroke would make spikes otherwise.
+            shape.finish(
+                color=color,
+                width=drawing["width"],
+                stroke_opacity=opacity,
+                lineJoin=1,
+                closePath=False,
             )
+        shape.commit()
 
-    doc.save(pdf_path)
+    # Never leave a half-written PDF behind at `pdf_path`.
+    tmp_path = sibling_temp_path(pdf_path)
+    try:
+        doc.save(tmp_path)
+        os.replace(tmp_path, pdf_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+@functools.lru_cache(maxsize=256)
+def parse_drawing_color(color: str) -> tuple[tuple[float, float, float], float]:
+    """
+    Stroke color and opacity of a drawing, pens reuse a handful of colors.
+    """
+    from color_parser_py import ColorParser
+
+    try:
+        colors = ColorParser(color).rgba_float
+    except ValueError:
+        print(f"Can't parse drawing color: {color}")
+        # Default to blue if color parsing fails
+        return (0.0, 0.0, 0.9), 1.0
+    return (colors[0], colors[1], colors[2]), colors[3] if len(colors) > 3 else 1.0
 
 
 class AnswerHtml(NamedTuple):
@@ -247,7 +317,7 @@ class AnswerHtml(NamedTuple):
 
 
 def create_answer_html(html_soup: bs4.BeautifulSoup) -> AnswerHtml:
-    html_page = bs4.BeautifulSoup("<!DOCTYPE html>", "html.parser")
+    html_page = parse_fragment("<!DOCTYPE html>")
     html_tag = html_page.new_tag("html", lang="en")
     head_tag = html_page.new_tag("head")
     body_tag = html_page.new_tag("body")
@@ -265,9 +335,13 @@ def create_answer_html(html_soup: bs4.BeautifulSoup) -> AnswerHtml:
         )
     else:
         head_tag.clear()
-        head_tag.extend(original_head_tag.contents)
+        # Copied, the original page may be used for more than one new page.
+        head_tag.extend([copy.copy(child) for child in original_head_tag.contents])
+        # Per-request tokens would make every archived copy differ from the last one.
+        for meta in head_tag.find_all("meta", attrs={"name": ["csrf-param", "csrf-token"]}):
+            meta.decompose()
     head_tag.append(
-        bs4.BeautifulSoup(
+        parse_fragment(
             """
                 <style>
                      body { 
@@ -284,14 +358,13 @@ def create_answer_html(html_soup: bs4.BeautifulSoup) -> AnswerHtml:
                         }
                     }
                 </style>
-            """,
-            "html.parser",
+            """
         )
     )
 
     original_body_tag = html_soup.find("body")
     if isinstance(original_body_tag, bs4.element.Tag):
-        body_tag.attrs = original_body_tag.attrs
+        body_tag.attrs = dict(original_body_tag.attrs)
     else:
         logger.warning(
             "body tag not found, attributes may be missing and page may not render correctly."
@@ -302,62 +375,107 @@ def create_answer_html(html_soup: bs4.BeautifulSoup) -> AnswerHtml:
     )
 
 
+@METRICS.traced("submission")
 async def download_answers(
-    url: URL, id: int, path: Path, async_session: aiohttp.ClientSession
-) -> None:
+    url: URL, id: int, path: Path, context: ArchiveContext
+) -> list[QuestionGrading]:
     new_url = url / str(id)
-    result = await async_session.get(new_url)
-    content = await result.text()
+    html_soup = (await context.pages.get(new_url)).soup
     tasks = []
-    tasks.append(download_submission(content, path, async_session))
+    tasks.append(download_submission(html_soup, new_url, path, context))
 
-    html_soup = bs4.BeautifulSoup(content, "html.parser")
-    questions = html_soup.find_all("div", attrs={"data-cy": "submission-button"})
-    question_links = [q.find("a")["data-submission-id"] for q in questions]
+    buttons = html_soup.find_all("div", attrs={"data-cy": "submission-button"})
+    question_links = [button.find("a")["data-submission-id"] for button in buttons]
     if len(question_links) == 0:
         logger.warning("No questions found.")
         await asyncio.gather(*tasks)
-        return
+        return []
 
-    new_html_page = create_answer_html(html_soup)
-    body_tag = new_html_page.body
-    main_tag = new_html_page.main
-    html_tag = new_html_page.html
-
-    results = [async_session.get(str(url / str(qid))) for qid in question_links]
-    responses = await asyncio.gather(*results)
-    fetched_pages = await asyncio.gather(*[resp.text() for resp in responses])
-
-    for page_content in fetched_pages:
-        html_soup2 = bs4.BeautifulSoup(page_content, "html.parser")
-        grading = html_soup2.find_all("div", attrs={"data-js-grading-panel": True})
-        is_v2 = False
-        if not grading:
-            grading = html_soup2.find_all("div", attrs={"data-js-review-panel": True})
-            is_v2 = True
-        for grading_panel in grading:
-            if is_v2:
-                logger.debug("Using grading scheme v2 for url: " + str(new_url))
-                grading_scheme_v2(main_tag, grading_panel, html_soup2)
-                continue
-
-            grading_scheme_v1(main_tag, grading_panel, new_url)
-
-    body_tag.append(main_tag)
-    body_tag.append(
-        bs4.BeautifulSoup(
-            '<div data-js-i18n data-default-locale="nl" data-locale="nl"></div>',
-            "html.parser",
-        )
+    new_html_page = await context.executor.run(create_answer_html, html_soup)
+    new_html_page.body.append(
+        parse_fragment('<div data-js-i18n data-default-locale="nl" data-locale="nl"></div>')
     )
-    html_tag.append(body_tag)
-    path.mkdir(parents=True, exist_ok=True)
-    with (path / "grading_panel.html").open("w", encoding="utf-8") as f:
-        f.write(str(new_html_page.page.prettify()))
+    page_path = path / "grading_panel.html"
+    if context.assets is not None:
+        await context.assets.localize(new_html_page.page, new_url, page_path)
+
+    # Every question is written as soon as it and the ones before it are in, so only
+    # the questions that arrived out of order are held in memory.
+    questions: list[tuple[int, str | None, str | None, int, int]] = []
+    gradings: list[QuestionGrading] = []
+    with HtmlStreamWriter(
+        context.manifest,
+        page_path,
+        new_html_page.page,
+        new_html_page.main,
+        context.config.compress_html,
+    ) as writer:
+        async for markup, grading in context.scheduler.imap(
+            "questions",
+            get_question_grading,
+            [(url / str(qid), new_url, page_path, context) for qid in question_links],
+        ):
+            offset = writer.size
+            writer.write(markup)
+            gradings.append(grading)
+            questions.append(
+                (len(questions) + 1, grading.title, grading.score, offset, writer.size - offset)
+            )
+    if context.store is not None:
+        context.store.record_questions(writer.path, questions)
     await asyncio.gather(*tasks)
+    return gradings
+
+
+async def get_question_grading(
+    question_url: URL, new_url: URL, page_path: Path, context: ArchiveContext
+) -> tuple[str, QuestionGrading]:
+    """
+    The markup of the grading panel of one question, as it goes into `page_path`, and
+    what was read from it.
+    """
+    # Only the grading panel needs the question pages, so they aren't kept in the page
+    # registry, `extract_grading` parses them on the executor.
+    response = await context.session.get(question_url)
+    text = await response.text()
+    container, grading = await context.executor.run(extract_grading, text, new_url)
+    if context.assets is not None:
+        await context.assets.localize(container, new_url, page_path)
+    return container.decode_contents(), grading
+
+
+def extract_grading(page_content: str, new_url: URL) -> tuple[bs4.Tag, QuestionGrading]:
+    """
+    Parse a question page and collect the parts of its grading panel that go into
+    `grading_panel.html` in a `<div>`, and the grading they show. Touches nothing but its
+    own soup, so it can run on the executor.
+    """
+    html_soup = parse_html(page_content)
+    question = QuestionGrading()
+    container = html_soup.new_tag("div")
+    # Both kinds of panels in one pass. A page with `data-js-grading-panel`s is parsed
+    # by those alone, its `data-js-review-panel`s are only parsed when it has none.
+    panels = html_soup.find_all(
+        lambda tag: tag.name == "div"
+        and (tag.has_attr("data-js-grading-panel") or tag.has_attr("data-js-review-panel"))
+    )
+    grading = [panel for panel in panels if panel.has_attr("data-js-grading-panel")]
+    is_v2 = not grading
+    if is_v2:
+        grading = panels
+    for grading_panel in grading:
+        if is_v2:
+            logger.debug("Using grading scheme v2 for url: " + str(new_url))
+            grading_scheme_v2(container, grading_panel, html_soup, question)
+            continue
+
+        grading_scheme_v1(container, grading_panel, new_url, question)
+    return container, question
 
 
-def grading_scheme_v1(main_tag: bs4.Tag, grading_panel: bs4.Tag, new_url: URL) -> None:
+def grading_scheme_v1(
+    main_tag: bs4.Tag, grading_panel: bs4.Tag, new_url: URL, question: QuestionGrading
+) -> None:
     parsing_dict = {
         "CRITERIA": parse_criteria,
         "SUBQUESTION": parse_sub_question,
@@ -368,15 +486,19 @@ def grading_scheme_v1(main_tag: bs4.Tag, grading_panel: bs4.Tag, new_url: URL) -
     for comment in comments:
         comments_list.append(comment.strip())
         comment_str: str = comment.strip()
+        if comment_str == "QUESTION":
+            question.title = element_text(comment.find_next_sibling())
+        elif comment_str == "POINTS":
+            question.set_score(element_text(comment.find_next_sibling()))
         if comment_str not in parsing_dict:
             continue
         parse_function: Callable[..., bs4.BeautifulSoup] = parsing_dict[comment_str]
-        parsed_data: bs4.BeautifulSoup = parse_function(comment.find_next_sibling())
+        parsed_data: bs4.BeautifulSoup = parse_function(comment.find_next_sibling(), question)
         main_tag.append(parsed_data)
 
     adjustments = grading_panel.find(attrs={"data-js-adjustments-wrapper": True})
     if adjustments:
-        main_tag.append(adjustments)
+        main_tag.append(parse_adjustments(adjustments, question))
     known_comments = [
         "QUESTION",
         "SUBQUESTION",
@@ -395,14 +517,21 @@ def grading_scheme_v1(main_tag: bs4.Tag, grading_panel: bs4.Tag, new_url: URL) -
 
 
 def grading_scheme_v2(
-    main_tag: bs4.Tag, grading_panel: bs4.Tag, full_page: bs4.BeautifulSoup
+    main_tag: bs4.Tag,
+    grading_panel: bs4.Tag,
+    full_page: bs4.BeautifulSoup,
+    question: QuestionGrading,
 ) -> None:
     for element_id in ["question-header", "subquestion-header", "criteria"]:
         element = grading_panel.find(id=element_id)
         if not element:
             continue
-        with open("test3.html", "w", encoding="utf-8") as f:
-            f.write(str(grading_panel.prettify()))
+        if element_id == "question-header":
+            question.title = element_text(element)
+        elif element_id == "subquestion-header":
+            parse_sub_question(element, question)
+        else:
+            parse_criteria(element, question)
         if element_id == "subquestion-header":
             current_question = full_page.find(
                 "div", attrs={"class": "question-button-indicator"}
@@ -413,9 +542,7 @@ def grading_scheme_v2(
                     number = question_number.text.strip()
                     element.insert(
                         0,
-                        bs4.BeautifulSoup(
-                            f'<div class="text-semi-bold mr-3"> {number} </div>'
-                        ),
+                        parse_fragment(f'<div class="text-semi-bold mr-3"> {number} </div>'),
                     )
         main_tag.append(element)
 
@@ -431,13 +558,13 @@ def grading_scheme_v2(
         "turbo-frame", id=lambda x: isinstance(x, str) and x.startswith("adjustment_")
     )
     if adjustment_frame:
-        main_tag.append(adjustment_frame)
+        main_tag.append(parse_adjustments(adjustment_frame, question))
     else:
         adjustments_attr = grading_panel.find(
             attrs={"data-js-adjustments-wrapper": True}
         )
         if adjustments_attr:
-            main_tag.append(adjustments_attr)
+            main_tag.append(parse_adjustments(adjustments_attr, question))
 
     score_summary = grading_panel.find(class_="score-summary")
     if not score_summary:
@@ -446,61 +573,42 @@ def grading_scheme_v2(
             id=lambda x: isinstance(x, str) and x.startswith("score_submission_"),
         )
     if score_summary:
+        question.set_score(element_text(score_summary))
         main_tag.append(score_summary)
 
 
-def parse_sub_question(grading_panel: bs4.BeautifulSoup) -> bs4.BeautifulSoup:
-    # subquestions = grading_panel.find_all("div", attrs={"data-js-subquestion": True})
-    # result = {}
-    # for subq in subquestions:
-    #     subq_id = subq["data-js-subquestion"]
-    #     comments = subq.find_all(string=lambda text: isinstance(text, bs4.Comment))
-    #     result[subq_id] = comments
-    # return result
-    # print("Parsing SUBQUESTION - function not yet implemented", grading_panel)
-    # return grading_panel.find("article") or grading_panel
+def parse_sub_question(grading_panel: bs4.Tag, question: QuestionGrading) -> bs4.Tag:
+    """
+    Start a subquestion in `question`, the criteria that follow belong to it.
+    """
+    question.subquestions.append(Subquestion(element_text(grading_panel)))
     return grading_panel
 
 
-def parse_criteria(grading_panel: bs4.BeautifulSoup) -> bs4.BeautifulSoup:
-    # criteria = grading_panel.find_all("div", attrs={"data-js-criterion": True})
-    # result = {}
-    # for criterion in criteria:
-    #     criterion_id = criterion["data-js-criterion"]
-    #     comments = criterion.find_all(string=lambda text: isinstance(text, bs4.Comment))
-    #     result[criterion_id] = comments
-    # return result
-    # print("Parsing CRITERIA - function not yet implemented", grading_panel.prettify())
-    # return grading_panel.find("article") or grading_panel
+def parse_criteria(grading_panel: bs4.Tag, question: QuestionGrading) -> bs4.Tag:
+    criteria = (
+        grading_panel.find_all(attrs={"data-js-criterion": True})
+        or grading_panel.find_all(class_="criterion")
+        or grading_panel.find_all(recursive=False)
+    )
+    question.add_criteria(
+        [
+            Criterion(text, parse_points(text))
+            for criterion in criteria
+            if (text := element_text(criterion)) is not None
+        ]
+    )
     return grading_panel
 
 
-async def switch_grading_schemes(
-    async_session: aiohttp.ClientSession,
-    html_soup: bs4.BeautifulSoup,
-    question_url: URL,
-) -> None:
-    response = await async_session.get(question_url)
-    text = await response.text()
-    html_soup = bs4.BeautifulSoup(text, "html.parser")
-    form = html_soup.find("form", attrs={"class": "button_to", "action": True})
-    if form is None:
-        logger.warning(
-            Fore.RED
-            + f"Grading scheme switch button not found on page: {question_url}. Cannot switch grading schemes."
-        )
-        return
-    action = form["action"]
-    input_el = form.find("input", attrs={"name": "authenticity_token"})
-    if (
-        input_el is None
-        or not input_el.has_attr("value")
-        or not isinstance(action, str)
-    ):
-        logger.warning(
-            Fore.RED
-            + f"Authenticity token input or action attribute not found in grading scheme switch button on page: {question_url}. Cannot switch grading schemes."
-        )
-        return
-    raw_body = {"authenticity_token": input_el["value"]}
-    await async_session.post(BASE_URL.join(URL(action)), data=raw_body)
+def parse_adjustments(adjustments: bs4.Tag, question: QuestionGrading) -> bs4.Tag:
+    items = adjustments.find_all(attrs={"data-js-adjustment": True}) or adjustments.find_all(
+        ["li", "article"]
+    ) or [adjustments]
+    for item in items:
+        text = element_text(item)
+        points = parse_points(text or "")
+        # Placeholders like "No adjustments" have no points.
+        if text is not None and points is not None:
+            question.adjustments.append(Adjustment(text, points))
+    return adjustments
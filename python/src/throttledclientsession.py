@@ -1,41 +1,151 @@
 import asyncio
+from collections import OrderedDict
+import copy
+import datetime
+import email.utils
+import hashlib
+import json
+import logging
+import os
+from pathlib import Path
 import random
 import time
 from typing import TypedDict
 
-from aiohttp import ClientHandlerType, ClientRequest, ClientResponse
+from aiohttp import (
+    ClientConnectionError,
+    ClientHandlerType,
+    ClientPayloadError,
+    ClientRequest,
+    ClientResponse,
+    hdrs,
+)
+from multidict import CIMultiDict, CIMultiDictProxy
 
+from .metrics import METRICS, request_kind
+from .utils import atomic_write_bytes
 
-class Stats(TypedDict):
-    count: int
-    requests_per_second: float
-    rate_limit: float
-    urls: list[str]
-    start_time: float
+logger = logging.getLogger("ans_archiver")
+
+
+def parse_retry_after(value: str | None) -> float | None:
+    """
+    Seconds to wait according to a `Retry-After` header, given either as a number of
+    seconds or as an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = email.utils.parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if retry_at.tzinfo is None:
+        retry_at = retry_at.replace(tzinfo=datetime.timezone.utc)
+    return max(0.0, (retry_at - datetime.datetime.now(datetime.timezone.utc)).total_seconds())
+
+
+def backoff_delay(attempt: int, base_delay: float = 0.5, max_delay: float = 30.0) -> float:
+    """
+    Exponential backoff with full jitter for the `attempt`-th retry (starting at 1).
+    """
+    return random.uniform(0, min(max_delay, base_delay * 2 ** (attempt - 1)))
+
+
+class TokenBucket:
+    """
+    Token bucket of a single host, refilled at `rate` tokens per second and holding at
+    most `burst` of them. Requests that find it empty take a token in advance and
+    wait until it would have been refilled.
+
+    The rate adapts AIMD style: it is halved (at most once a second) when the host
+    throttles and grows by `increase` with every successful response, between
+    `min_rate` and `max_rate`. A `Retry-After` empties the bucket until then and bumps
+    `generation`, so requests that were already waiting know to queue up again.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        burst: int,
+        min_rate: float,
+        max_rate: float,
+        increase: float,
+    ):
+        self.rate = rate
+        self.burst = burst
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.increase = increase
+        self.tokens = float(burst)
+        self.generation = 0
+        self._updated = time.monotonic()
+        self._last_decrease = -1.0
+
+    def reserve(self, now: float) -> float:
+        """
+        Take a token, returns how long to wait before it may be used.
+        """
+        if now > self._updated:
+            self.tokens = min(self.burst, self.tokens + (now - self._updated) * self.rate)
+            self._updated = now
+        self.tokens -= 1
+        # After a `Retry-After` the bucket only starts refilling once it has passed.
+        delay = self._updated - now
+        return delay + (-self.tokens / self.rate if self.tokens < 0 else 0.0)
+
+    def on_success(self) -> None:
+        self.rate = min(self.max_rate, self.rate + self.increase)
+
+    def on_throttled(self, now: float, retry_after: float | None) -> None:
+        if retry_after is not None and now + retry_after > self._updated:
+            self.tokens = 0.0
+            self._updated = now + retry_after
+            self.generation += 1
+        if now - self._last_decrease >= 1.0:
+            self._last_decrease = now
+            self.rate = max(self.min_rate, self.rate / 2)
+            logger.warning(
+                f"Server is throttling requests, slowing down to {self.rate:.2f} requests per second."
+            )
 
 
 class RateLimitMiddleware:
     """
-    Very simple RPS limiter with jitter.
+    Per-host token bucket limiter with jitter that slows down when the server answers
+    with 429 or 5xx, honors `Retry-After` and speeds back up after successes.
+    A `rate_limit` of 0 or less disables it.
     """
 
     def __init__(
         self,
         rate_limit: float | int,
         jitter_factor: float,
+        burst: int = 1,
+        max_rate_limit: float | None = None,
+        min_rate_limit: float = 0.2,
     ):
         self._rate_limit = rate_limit
         self._jitter_factor = jitter_factor
-        self._stats: Stats = {
-            "count": 0,
-            "requests_per_second": 0.0,
-            "rate_limit": rate_limit,
-            "urls": [],
-            "start_time": -1,
-        }
+        self._burst = max(1, burst)
+        self._max_rate_limit = max(rate_limit, max_rate_limit or rate_limit)
+        self._min_rate_limit = min(rate_limit, min_rate_limit)
+        self._buckets: dict[str, TokenBucket] = {}
 
-        self._lock: asyncio.Lock | None = None
-        self._next_allowed_time: float = -1
+    def _bucket(self, host: str) -> TokenBucket:
+        bucket = self._buckets.get(host)
+        if bucket is None:
+            bucket = self._buckets[host] = TokenBucket(
+                rate=self._rate_limit,
+                burst=self._burst,
+                min_rate=self._min_rate_limit,
+                max_rate=self._max_rate_limit,
+                # Recovering from a halving takes about 50 successful requests.
+                increase=self._max_rate_limit / 100,
+            )
+        return bucket
 
     async def __call__(
         self,
@@ -43,44 +153,294 @@ class RateLimitMiddleware:
         handler: ClientHandlerType,
     ) -> ClientResponse:
         host = request.url.host
-        if not host:
-            return await handler(request)
-        self._stats["count"] += 1
-        self._stats["urls"].append(str(request.url))
-
-        if self._rate_limit <= 0:
+        if not host or self._rate_limit <= 0:
             return await handler(request)
 
-        base_interval = 1.0 / self._rate_limit
+        bucket = self._bucket(host)
+        start = time.monotonic()
+        while True:
+            generation = bucket.generation
+            delay = bucket.reserve(time.monotonic())
+            if self._jitter_factor > 0:
+                delay += self._jitter_factor * random.random() / bucket.rate
+            if delay > 0:
+                await asyncio.sleep(delay)
+            # Unless the host asked us to back off while we were waiting.
+            if bucket.generation == generation:
+                break
+        METRICS.observe("phase_seconds", time.monotonic() - start, phase="limiter")
 
-        if self._jitter_factor > 0:
-            interval = base_interval * (1.0 + self._jitter_factor * random.random())
+        response = await handler(request)
+        if response.status == 429 or response.status >= 500:
+            METRICS.increment("throttled_total", host=host)
+            bucket.on_throttled(
+                time.monotonic(), parse_retry_after(response.headers.get(hdrs.RETRY_AFTER))
+            )
         else:
-            interval = base_interval
-        if self._lock is None:
-            self._lock = asyncio.Lock()
-        async with self._lock:
-            now = time.monotonic()
-            t = self._next_allowed_time
-
-            slot = max(now, t)
-            self._next_allowed_time = slot + interval
-            if self._stats["start_time"] < 0:
-                self._stats["start_time"] = now - interval
-                self._stats["requests_per_second"] = self._rate_limit
+            bucket.on_success()
+        return response
+
+    def get_rates(self) -> dict[str, float]:
+        """
+        Current requests per second of every host.
+        """
+        return {host: bucket.rate for host, bucket in self._buckets.items()}
+
+
+class MetricsMiddleware:
+    """
+    Records the latency, status and kind of every request that goes out. Put it last,
+    so only the time spent on the network is measured.
+    """
+
+    async def __call__(
+        self,
+        request: ClientRequest,
+        handler: ClientHandlerType,
+    ) -> ClientResponse:
+        kind = request_kind(request.url)
+        start = time.perf_counter()
+        status = "error"
+        try:
+            with METRICS.span(f"{request.method} {kind}", url=str(request.url)):
+                response = await handler(request)
+            status = str(response.status)
+            return response
+        finally:
+            elapsed = time.perf_counter() - start
+            METRICS.observe("request_seconds", elapsed, kind=kind)
+            METRICS.observe("phase_seconds", elapsed, phase="network")
+            METRICS.increment("requests_total", kind=kind, status=status)
+
+
+RETRY_STATUSES = frozenset({408, 429, 500, 502, 503, 504})
+IDEMPOTENT_METHODS = frozenset(
+    {hdrs.METH_GET, hdrs.METH_HEAD, hdrs.METH_OPTIONS, hdrs.METH_PUT, hdrs.METH_DELETE}
+)
+
+
+class RetryMiddleware:
+    """
+    Retries idempotent requests that fail with a connection error or a retryable
+    status, with jittered exponential backoff (at least as long as `Retry-After`).
+
+    All retries of a run draw from one `budget`, once it is used up failures are passed
+    on right away, so an outage fails the run quickly instead of backing off for hours.
+    Put it before the cache and the rate limiter, so every attempt is paced.
+    """
+
+    def __init__(self, retries: int, budget: int, base_delay: float = 0.5, max_delay: float = 30.0):
+        self._retries = retries
+        self._budget = budget
+        self._base_delay = base_delay
+        self._max_delay = max_delay
+
+    def _may_retry(self, attempt: int) -> bool:
+        if attempt > self._retries:
+            return False
+        if self._budget <= 0:
+            METRICS.increment("retries_exhausted_total")
+            return False
+        self._budget -= 1
+        METRICS.increment("retries_total")
+        return True
+
+    async def __call__(
+        self,
+        request: ClientRequest,
+        handler: ClientHandlerType,
+    ) -> ClientResponse:
+        if request.method not in IDEMPOTENT_METHODS:
+            return await handler(request)
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                response = await handler(request)
+            except (ClientConnectionError, ClientPayloadError, asyncio.TimeoutError) as e:
+                if not self._may_retry(attempt):
+                    raise
+                delay = backoff_delay(attempt, self._base_delay, self._max_delay)
+                reason = repr(e)
             else:
-                elapsed = slot - self._stats["start_time"]
-                self._stats["requests_per_second"] = self._stats["count"] / elapsed
-
-        sleep_duration = slot - now
-        if sleep_duration > 0:
-            await asyncio.sleep(sleep_duration)
-        return await handler(request)
-
-    def get_stats(self) -> str:
-        return (
-            f"Count: {self._stats['count']}, \n"
-            f"Requests per second: {self._stats['requests_per_second']:.2f}, \n"
-            f"Rate Limit: {self._stats['rate_limit']}, \n"
-            f"URLs: {len(self._stats['urls'])}, \n"
+                if response.status not in RETRY_STATUSES or not self._may_retry(attempt):
+                    return response
+                retry_after = parse_retry_after(response.headers.get(hdrs.RETRY_AFTER)) or 0.0
+                delay = max(backoff_delay(attempt, self._base_delay, self._max_delay), retry_after)
+                reason = f"status {response.status}"
+                response.release()
+            logger.warning(
+                f"Request to {request.url} failed with {reason}, retrying in {delay:.1f}s (attempt {attempt}/{self._retries})."
+            )
+            await asyncio.sleep(delay)
+
+
+class CacheEntry(TypedDict):
+    url: str
+    etag: str | None
+    last_modified: str | None
+    content_type: str | None
+
+
+class DiskCache:
+    """
+    Response bodies stored on disk keyed by url, evicted least recently used first
+    once their total size exceeds `max_size` bytes.
+    """
+
+    def __init__(self, directory: Path, max_size: int):
+        self._directory = directory
+        self._max_size = max_size
+        directory.mkdir(parents=True, exist_ok=True)
+        bodies = sorted(directory.glob("*.body"), key=lambda p: p.stat().st_mtime)
+        self._sizes: OrderedDict[str, int] = OrderedDict(
+            (body.stem, body.stat().st_size) for body in bodies
         )
+        self._size = sum(self._sizes.values())
+
+    def _paths(self, url: str) -> tuple[str, Path, Path]:
+        key = hashlib.sha256(url.encode("utf-8")).hexdigest()
+        return key, self._directory / f"{key}.body", self._directory / f"{key}.json"
+
+    def get(self, url: str) -> tuple[CacheEntry, bytes] | None:
+        key, body_path, meta_path = self._paths(url)
+        if key not in self._sizes:
+            return None
+        try:
+            entry: CacheEntry = json.loads(meta_path.read_text(encoding="utf-8"))
+            body = body_path.read_bytes()
+        except (OSError, ValueError):
+            self.remove(url)
+            return None
+        if entry["url"] != url:
+            return None
+        self._sizes.move_to_end(key)
+        os.utime(body_path)
+        return entry, body
+
+    def put(self, entry: CacheEntry, body: bytes) -> None:
+        # Also when the new body is too big to keep, a 304 must never be answered with
+        # the old one.
+        self.remove(entry["url"])
+        if len(body) > self._max_size:
+            return
+        key, body_path, meta_path = self._paths(entry["url"])
+        # An entry without its metadata is ignored, so the body goes first.
+        atomic_write_bytes(body_path, body)
+        atomic_write_bytes(meta_path, json.dumps(entry).encode("utf-8"))
+        self._sizes[key] = len(body)
+        self._size += len(body)
+        while self._size > self._max_size:
+            oldest, size = self._sizes.popitem(last=False)
+            self._size -= size
+            for suffix in (".body", ".json"):
+                (self._directory / f"{oldest}{suffix}").unlink(missing_ok=True)
+
+    def remove(self, url: str) -> None:
+        key, body_path, meta_path = self._paths(url)
+        self._size -= self._sizes.pop(key, 0)
+        body_path.unlink(missing_ok=True)
+        meta_path.unlink(missing_ok=True)
+
+
+class ResponseCacheMiddleware:
+    """
+    Caches text responses of GET requests and revalidates them with conditional
+    requests (`If-None-Match`/`If-Modified-Since`), a `304 Not Modified` is answered
+    with the stored body. Concurrent requests for the same url share one response.
+
+    Put it before the rate limiter so shared responses don't take up a slot.
+    """
+
+    CACHEABLE_TYPES = ("text/", "application/json")
+
+    def __init__(self, storage: DiskCache):
+        self._storage = storage
+        self._in_flight: dict[str, asyncio.Future[ClientResponse | None]] = {}
+
+    async def __call__(
+        self,
+        request: ClientRequest,
+        handler: ClientHandlerType,
+    ) -> ClientResponse:
+        if request.method != hdrs.METH_GET:
+            return await handler(request)
+        url = str(request.url)
+        in_flight = self._in_flight.get(url)
+        if in_flight is not None:
+            shared = await asyncio.shield(in_flight)
+            if shared is not None:
+                METRICS.increment("cache_total", result="shared")
+                return copy.copy(shared)
+            return await handler(request)
+
+        future: asyncio.Future[ClientResponse | None] = asyncio.get_running_loop().create_future()
+        self._in_flight[url] = future
+        response: ClientResponse | None = None
+        try:
+            response = await self._fetch(url, request, handler)
+            return response
+        finally:
+            del self._in_flight[url]
+            # Only responses with a body in memory can be handed to several readers.
+            shareable = response is not None and response._body is not None
+            future.set_result(response if shareable else None)
+
+    async def _fetch(
+        self,
+        url: str,
+        request: ClientRequest,
+        handler: ClientHandlerType,
+    ) -> ClientResponse:
+        cached = self._storage.get(url)
+        if cached is not None:
+            entry, body = cached
+            if entry["etag"]:
+                request.headers[hdrs.IF_NONE_MATCH] = entry["etag"]
+            if entry["last_modified"]:
+                request.headers[hdrs.IF_MODIFIED_SINCE] = entry["last_modified"]
+
+        response = await handler(request)
+        if response.status == 304 and cached is not None:
+            await response.read()
+            METRICS.increment("cache_total", result="revalidated")
+            return _revive(response, *cached)
+
+        content_type = response.headers.get(hdrs.CONTENT_TYPE, "")
+        if response.status != 200 or not content_type.startswith(self.CACHEABLE_TYPES):
+            return response
+        body = await response.read()
+        etag = response.headers.get(hdrs.ETAG)
+        last_modified = response.headers.get(hdrs.LAST_MODIFIED)
+        no_store = "no-store" in response.headers.get(hdrs.CACHE_CONTROL, "")
+        if (etag or last_modified) and not no_store:
+            self._storage.put(
+                {
+                    "url": url,
+                    "etag": etag,
+                    "last_modified": last_modified,
+                    "content_type": content_type,
+                },
+                body,
+            )
+            METRICS.increment("cache_total", result="stored")
+        elif cached is not None:
+            self._storage.remove(url)
+        return response
+
+
+def _revive(response: ClientResponse, entry: CacheEntry, body: bytes) -> ClientResponse:
+    """
+    Turn a `304 Not Modified` response into the `200 OK` response it stands for.
+    """
+    headers = CIMultiDict(response.headers)
+    if entry["content_type"]:
+        headers[hdrs.CONTENT_TYPE] = entry["content_type"]
+    headers[hdrs.CONTENT_LENGTH] = str(len(body))
+    response._headers = CIMultiDictProxy(headers)
+    # `headers` is a cached property, it may have been read already.
+    response._cache.pop("headers", None)
+    response.status = 200
+    response.reason = "OK"
+    response._body = body
+    return response
@@ -0,0 +1,40 @@
+from typing import TYPE_CHECKING, NamedTuple
+
+if TYPE_CHECKING:
+    # Only imported once a session is made, the options are read without it.
+    import aiohttp
+
+DEFAULT_CONNECTIONS = 100
+# Longer than aiohttp's 15s, so connections survive the pauses between assignments.
+DEFAULT_KEEPALIVE_TIMEOUT = 60.0
+DEFAULT_DNS_CACHE_TTL = 300
+
+
+class TransportConfig(NamedTuple):
+    """
+    How the connections to the server are pooled.
+    """
+
+    # Open connections in total, idle ones included.
+    connections: int = DEFAULT_CONNECTIONS
+    # Open connections per host, so one host can't take the whole pool.
+    connections_per_host: int = 0
+    # Seconds an idle connection is kept open for the next request.
+    keepalive_timeout: float = DEFAULT_KEEPALIVE_TIMEOUT
+    # Seconds a resolved address is reused, `None` to resolve every new connection.
+    dns_cache_ttl: int | None = DEFAULT_DNS_CACHE_TTL
+
+
+def tcp_connector(config: TransportConfig) -> "aiohttp.BaseConnector":
+    """
+    aiohttp's own pool of keep-alive HTTP/1.1 connections.
+    """
+    import aiohttp
+
+    return aiohttp.TCPConnector(
+        limit=config.connections,
+        limit_per_host=config.connections_per_host,
+        keepalive_timeout=config.keepalive_timeout,
+        use_dns_cache=config.dns_cache_ttl is not None,
+        ttl_dns_cache=config.dns_cache_ttl,
+    )
@@ -1,15 +1,13 @@
+import asyncio
+from collections import OrderedDict
+from collections.abc import AsyncIterator, Callable, Coroutine
+import glob
 import logging
+import os
+from pathlib import Path
+import tempfile
+from typing import cast
 from colorama import Fore
-import requests
-from yarl._url import URL
-
-
-class URLSession(requests.Session):
-    def get(self, url: str | URL, *args, **kwargs) -> requests.Response:
-        return super().get(str(url), *args, **kwargs)
-
-    def post(self, url: str | URL, *args, **kwargs) -> requests.Response:
-        return super().post(str(url), *args, **kwargs)
 
 
 def sanitize_filename(name: str) -> str:
@@ -19,6 +17,115 @@ def sanitize_filename(name: str) -> str:
     return name.strip()
 
 
+# Only readable by setting it, so read once at import.
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def sibling_temp_path(path: Path, suffix: str = ".tmp") -> Path:
+    """
+    Unique, hidden file next to `path`, to be renamed over it once completely written.
+    """
+    path.parent.mkdir(parents=True, exist_ok=True)
+    fd, name = tempfile.mkstemp(prefix=f".{path.name}.", suffix=suffix, dir=path.parent)
+    try:
+        # `mkstemp` makes the file private, give it the mode a plain `open` would.
+        os.chmod(fd, 0o666 & ~UMASK)
+    finally:
+        os.close(fd)
+    return Path(name)
+
+
+def remove_stale_parts(path: Path) -> None:
+    """
+    Remove the `.part` files of downloads to `path` that a killed run left behind.
+    Only while nothing else is downloading to `path`.
+    """
+    for part in path.parent.glob(f".{glob.escape(path.name)}.*.part"):
+        part.unlink(missing_ok=True)
+
+
+def atomic_write_bytes(path: Path, data: bytes) -> None:
+    """
+    Write `data` to `path` through a temporary file, so an interrupted write never
+    leaves a truncated file at `path`.
+    """
+    tmp_path = sibling_temp_path(path)
+    try:
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+async def merge_async_iterators[T](*iterators: AsyncIterator[T]) -> AsyncIterator[T]:
+    """
+    Yield the items of all `iterators` in the order they arrive, reading them
+    concurrently.
+    """
+    queue: asyncio.Queue[tuple[bool, T | None]] = asyncio.Queue()
+
+    async def drain(iterator: AsyncIterator[T]) -> None:
+        try:
+            async for item in iterator:
+                queue.put_nowait((False, item))
+        finally:
+            queue.put_nowait((True, None))
+
+    tasks = [asyncio.create_task(drain(iterator)) for iterator in iterators]
+    remaining = len(tasks)
+    try:
+        while remaining:
+            done, item = await queue.get()
+            if done:
+                remaining -= 1
+                continue
+            yield cast(T, item)
+        # Let exceptions of the iterators surface.
+        await asyncio.gather(*tasks)
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+class AsyncLruCache[K, V]:
+    """
+    Results of coroutines by key, so each is computed at most once. Concurrent calls
+    for a key share one task, failures aren't remembered.
+
+    Keeps the `max_size` most recently used results.
+    """
+
+    def __init__(self, max_size: int):
+        self._max_size = max_size
+        self._tasks: OrderedDict[K, asyncio.Task[V]] = OrderedDict()
+
+    async def get(self, key: K, compute: Callable[[], Coroutine[object, object, V]]) -> V:
+        """
+        The result for `key`, running `compute()` for it unless it's known already.
+        """
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.create_task(compute())
+            while len(self._tasks) > self._max_size:
+                self._tasks.popitem(last=False)
+        else:
+            self._tasks.move_to_end(key)
+        try:
+            # A caller that is cancelled doesn't cancel the others.
+            return await asyncio.shield(task)
+        except Exception:
+            if self._tasks.get(key) is task:
+                del self._tasks[key]
+            raise
+
+    def invalidate(self, key: K) -> None:
+        self._tasks.pop(key, None)
+
+    def clear(self) -> None:
+        self._tasks.clear()
+
+
 class ColoredFormatter(logging.Formatter):
     COLORS = {
         # logging.DEBUG: Fore.WHITE,
@@ -0,0 +1,201 @@
+import asyncio
+from collections.abc import AsyncIterator
+import contextlib
+import logging
+import os
+from pathlib import Path
+import socket
+import sqlite3
+import time
+from typing import NamedTuple
+
+logger = logging.getLogger("ans_archiver")
+
+QUEUE_NAME = ".ans_queue.sqlite3"
+# A worker that doesn't renew its leases for this long is assumed to have crashed.
+LEASE_SECONDS = 300.0
+# Failed assignments are handed out again until they failed this often.
+MAX_ATTEMPTS = 3
+
+
+class WorkItem(NamedTuple):
+    url: str
+    course: str
+    name: str
+
+
+class WorkQueue:
+    """
+    Durable list of the assignments to archive, stored in `BASE_PATH`, shared by a
+    coordinator that fills it and any number of worker processes that work it off.
+
+    Workers claim assignments with a lease they keep renewing while they are alive.
+    The assignments of a worker that crashed are handed out again once its leases ran
+    out, and an assignment is only ever leased to one worker at a time.
+
+    The coordinator seals the queue once it listed every assignment, until then an
+    empty queue only means the workers are ahead of it.
+    """
+
+    def __init__(self, base_path: Path):
+        base_path.mkdir(parents=True, exist_ok=True)
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        # Autocommit, transactions are started explicitly so claims can lock the queue.
+        self._connection = sqlite3.connect(base_path / QUEUE_NAME, timeout=30, isolation_level=None)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute(
+            """
+            CREATE TABLE IF NOT EXISTS items (
+                url TEXT PRIMARY KEY,
+                course TEXT NOT NULL,
+                name TEXT NOT NULL,
+                state TEXT NOT NULL DEFAULT 'pending',
+                owner TEXT,
+                lease_until REAL,
+                attempts INTEGER NOT NULL DEFAULT 0
+            )
+            """
+        )
+        self._connection.execute(
+            "CREATE TABLE IF NOT EXISTS flags (name TEXT PRIMARY KEY, value INTEGER NOT NULL)"
+        )
+
+    def close(self) -> None:
+        self._connection.close()
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        self._connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield
+        except BaseException:
+            self._connection.execute("ROLLBACK")
+            raise
+        self._connection.execute("COMMIT")
+
+    def enqueue(self, items: list[WorkItem]) -> None:
+        """
+        Add `items` to the queue, assignments that were finished or given up on are
+        queued again, the ones a worker is busy with are left alone.
+        """
+        with self._transaction():
+            self._connection.executemany(
+                """
+                INSERT INTO items (url, course, name) VALUES (?, ?, ?)
+                ON CONFLICT(url) DO UPDATE SET
+                    course = excluded.course,
+                    name = excluded.name,
+                    state = 'pending',
+                    owner = NULL,
+                    attempts = 0
+                WHERE items.state != 'leased'
+                """,
+                items,
+            )
+
+    def unseal(self) -> None:
+        """
+        Tell the workers more assignments are coming, until `seal` is called.
+        """
+        self._set_flag("sealed", False)
+
+    def seal(self) -> None:
+        """
+        Tell the workers every assignment is in the queue, so they can stop once it is
+        worked off.
+        """
+        self._set_flag("sealed", True)
+
+    def is_sealed(self) -> bool:
+        row = self._connection.execute("SELECT value FROM flags WHERE name = 'sealed'").fetchone()
+        return row is not None and bool(row[0])
+
+    def _set_flag(self, name: str, value: bool) -> None:
+        with self._transaction():
+            self._connection.execute(
+                "INSERT OR REPLACE INTO flags VALUES (?, ?)", (name, int(value))
+            )
+
+    def claim(self) -> WorkItem | None:
+        """
+        Lease the next assignment that is pending, or whose lease ran out, to this
+        worker. `None` if there is nothing to claim right now.
+        """
+        now = time.time()
+        with self._transaction():
+            row = self._connection.execute(
+                """
+                SELECT url, course, name FROM items
+                WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?)
+                ORDER BY rowid LIMIT 1
+                """,
+                (now,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._connection.execute(
+                "UPDATE items SET state = 'leased', owner = ?, lease_until = ? WHERE url = ?",
+                (self.worker_id, now + LEASE_SECONDS, row[0]),
+            )
+        return WorkItem(*row)
+
+    def renew(self) -> None:
+        """
+        Extend the leases of every assignment this worker holds.
+        """
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE items SET lease_until = ? WHERE state = 'leased' AND owner = ?",
+                (time.time() + LEASE_SECONDS, self.worker_id),
+            )
+
+    def complete(self, url: str) -> None:
+        with self._transaction():
+            self._connection.execute(
+                "UPDATE items SET state = 'done', owner = NULL WHERE url = ? AND owner = ?",
+                (url, self.worker_id),
+            )
+
+    def release(self, url: str) -> None:
+        """
+        Hand a failed assignment back, it's given up on after `MAX_ATTEMPTS` failures.
+        """
+        with self._transaction():
+            self._connection.execute(
+                """
+                UPDATE items SET
+                    attempts = attempts + 1,
+                    state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'pending' END,
+                    owner = NULL
+                WHERE url = ? AND owner = ?
+                """,
+                (MAX_ATTEMPTS, url, self.worker_id),
+            )
+
+    def unfinished(self) -> int:
+        """
+        Assignments that are pending or being worked on by any worker.
+        """
+        row = self._connection.execute(
+            "SELECT COUNT(*) FROM items WHERE state IN ('pending', 'leased')"
+        ).fetchone()
+        return row[0]
+
+    @contextlib.asynccontextmanager
+    async def keep_leases(self) -> AsyncIterator[None]:
+        """
+        Renew the leases of this worker in the background until the block is left.
+        """
+
+        async def renew() -> None:
+            while True:
+                await asyncio.sleep(LEASE_SECONDS / 3)
+                self.renew()
+
+        task = asyncio.create_task(renew())
+        try:
+            yield
+        finally:
+            task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await task